@@ -1,32 +1,61 @@
 # -*- coding: utf-8 -*-
-from PyQt5.QtWidgets import *
-from PyQt5.QtCore import *
-from PyQt5.QtGui import *
+# 最先导入, 使用 --startup-report 参数时记录之后每个模块的导入耗时
+from startup_report import STARTUP_REPORT
+from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QDialog, QFrame, QLabel, QLineEdit, QTextEdit,
+                             QPushButton, QRadioButton, QProgressBar, QVBoxLayout, QHBoxLayout, QMenu, QActionGroup,
+                             QMessageBox, QSystemTrayIcon, QGraphicsDropShadowEffect)
+from PyQt5.QtCore import Qt, QTimer, QUrl, QRegExp, pyqtSignal
+from PyQt5.QtGui import QColor, QFont, QIcon, QPixmap, QRegExpValidator, QDesktopServices
 import sys
 import os
-import subprocess
-import requests
-from PyQt5.QtWidgets import QDialog, QLineEdit, QVBoxLayout, QHBoxLayout, QLabel, QPushButton, QRadioButton
-from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QIntValidator
 from network_opcodes import Opcodes
 import json
-import aiohttp
 import asyncio
-import hashlib
+import threading
+import time
+import shutil
 from pathlib import Path
 import urllib.parse
-import psutil
-from ctypes import *
-from ctypes.wintypes import *
-import win32process
+# 启动时只导入检查登录器是否已在运行需要的win32模块;
+# 更新和校验用到的file_manifest、download_manager, aiohttp(http_client中)、psutil、
+# 启动游戏用到的win32模块和ctypes在第一次使用时才导入, 不拖慢窗口显示
 import win32event
-import win32con
 import win32api
-import win32security
 import winerror
 
+STARTUP_REPORT.mark("导入模块")
+
+# 本地文件校验模式
+VERIFY_MODE_NAMES = {
+    "quick": "快速(只比较文件大小)",
+    "standard": "标准(文件有变化时计算哈希)",
+    "deep": "完整(游戏运行时后台校验所有文件)"
+}
+
+# 下载进度条每秒最多刷新的次数
+PROGRESS_FPS = 20
+
+# 上次获取的服务器信息和状态, 启动时先显示, 不等待服务器响应
+SERVER_INFO_CACHE_FILE = 'server_info_cache.json'
+
+# 缩放到窗口大小的背景图片缓存, 保存为BMP, 启动时不需要解码和缩放原图
+BACKGROUND_IMAGE = 'bg.jpg'
+BACKGROUND_CACHE_FILE = 'bg_cache.bmp'
+
+# 托盘菜单中可选的下载限速(KB/s), 0为不限速
+RATE_LIMIT_CHOICES = [0, 256, 512, 1024, 2048, 5120, 10240]
+# 更新下载和后台预下载两种限速
+RATE_LIMIT_NAMES = {
+    "download": "更新下载限速",
+    "background": "后台预下载限速"
+}
+
 class WowLauncher(QMainWindow):
+    # 后台事件循环线程通知界面线程的信号
+    log_signal = pyqtSignal(str)
+    # (函数, 参数) 在界面线程中调用
+    gui_call_signal = pyqtSignal(object, object)
+
     def __init__(self):
         # 创建互斥锁
         self.mutex = win32event.CreateMutex(None, False, "WowLauncherMutex")
@@ -39,6 +68,9 @@ class WowLauncher(QMainWindow):
         
         # 1. 首先加载配置文件
         self.load_config()
+        # 所有网络请求共用的HTTP客户端
+        from http_client import HttpClient
+        self.http = HttpClient(self.api_base_url)
         
         # 2. 设置窗口标题和大小
         self.setWindowTitle("连接中...")  # 初始标题，等待从服务器获取
@@ -54,32 +86,63 @@ class WowLauncher(QMainWindow):
         self.check_update_before_play = 1
         self.announcements = ["暂无公告"]
         self.encryption_key = "@@112233"
-        # 4. 创建事件循环
+        # 大文件分段下载的连接数和大小阈值, 由服务器配置
+        self.download_segments = 1
+        self.segment_threshold = 64 * 1024 * 1024
+        # 同时下载的文件数
+        self.parallel_downloads = 4
+        # 本地文件校验模式, 由服务器配置
+        self.verify_mode = "standard"
+        # 服务器提供的安装方案, 玩家选择的方案(install_profile)保存在配置文件中
+        self.install_profiles = []
+        # 下载限速(KB/s, 0为不限速), 玩家没有设置(rate_limits中没有)时使用服务器的建议值
+        self.server_rate_limits = {"download": 0, "background": 1024}
+        # 限速器在第一次下载前创建(create_rate_limiters), 启动时不导入下载模块
+        self.download_limiter = None
+        self.staging_limiter = None
+        # 提前启动游戏后, 剩余文件的更新同时受后台限速限制, 避免影响游戏
+        self.game_started_during_update = False
+        # 本地文件索引: 文件状态未变化时不重新计算哈希, 第一次检查更新时加载
+        self.file_index = None
+        # 4. 创建事件循环, 在后台线程中运行, 网络请求和文件哈希不阻塞界面
+        self.log_signal.connect(self.append_log)
+        self.gui_call_signal.connect(lambda func, args: func(*args))
         self.loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(self.loop)
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.loop_thread.start()
+        self.status_future = None
+        self.update_future = None
+        self.update_task = None
+        self.launch_after_update = False
+        self.verify_future = None
+        # 后台预下载待发布版本; pending_hashes为待发布版本的文件哈希, 还没有获取过时为None
+        self.staging_future = None
+        # 从托盘菜单退出时为True, 此时关闭窗口才真正退出
+        self.quitting = False
+        # 关闭窗口最小化到托盘后为True, 显示主窗口时恢复为False
+        self.in_tray = False
+        self.pending_hashes = None
         
         # 5. 添加背景图片
         self.background = QLabel(self)
         self.background.setGeometry(0, 0, 1228, 921)
-        self.background.setPixmap(QPixmap("bg.jpg").scaled(
-            1228, 
-            921,
-            Qt.KeepAspectRatioByExpanding,
-            Qt.SmoothTransformation
-        ))
+        self.background.setPixmap(self.load_background(1228, 921))
 
         # 6. 设置UI
         self.setup_ui()
         
         # 初始化系统托盘
         self.setup_tray_icon()
+
+        # 先显示上次缓存的服务器信息, 界面立即可用
+        self.load_server_info_cache()
         
         # 7. 启动时立即获取服务器信息和状态
-        self.loop.run_until_complete(self.initial_update())
+        self.run_async(self.initial_update())
         
         # 8. 创建定时器定期更新服务器状态
         self.timer = QTimer()
-        self.timer.timeout.connect(self.update_server_status)
+        self.timer.timeout.connect(self.on_status_timer)
         self.timer.start(60000)  # 每60秒更新一次
 
     def load_config(self):
@@ -97,6 +160,8 @@ class WowLauncher(QMainWindow):
                 self.api_host = config.get('api_host', 'localhost')
                 self.api_port = config.get('api_port', '8080')
                 self.api_base_url = f"http://{self.api_host}:{self.api_port}"
+                self.install_profile = config.get('install_profile')
+                self.rate_limits = config.get('rate_limits', {})
                 print(f"成功加载服务器配置: {self.api_base_url}")
         except Exception as e:
             print(f"加载配置文件失败: {str(e)}")
@@ -105,44 +170,96 @@ class WowLauncher(QMainWindow):
             self.api_host = 'localhost'
             self.api_port = '8080'
             self.api_base_url = f"http://{self.api_host}:{self.api_port}"
+            self.install_profile = None
+            self.rate_limits = {}
+
+    def load_background(self, width, height):
+        """返回缩放并裁剪到窗口大小的背景图片, 优先使用缓存, 原图比缓存新或尺寸不同时重新生成"""
+        try:
+            if (os.path.exists(BACKGROUND_CACHE_FILE)
+                    and os.path.getmtime(BACKGROUND_CACHE_FILE) >= os.path.getmtime(BACKGROUND_IMAGE)):
+                pixmap = QPixmap(BACKGROUND_CACHE_FILE)
+                if pixmap.width() == width and pixmap.height() == height:
+                    return pixmap
+        except OSError:
+            pass
+
+        # 裁掉超出窗口的部分, 与背景标签的默认对齐方式(水平靠左, 垂直居中)显示的区域相同
+        pixmap = QPixmap(BACKGROUND_IMAGE).scaled(
+            width,
+            height,
+            Qt.KeepAspectRatioByExpanding,
+            Qt.SmoothTransformation
+        )
+        pixmap = pixmap.copy(0, (pixmap.height() - height) // 2, width, height)
+        if not pixmap.isNull() and not pixmap.save(BACKGROUND_CACHE_FILE, "BMP"):
+            print(f"保存背景图片缓存失败: {BACKGROUND_CACHE_FILE}")
+        return pixmap
+
+    def save_launcher_config(self, **values):
+        """把登录器设置写入配置文件, 保留文件中的其他配置"""
+        config_path = 'launcher_config.json'
+        try:
+            config = {}
+            if os.path.exists(config_path):
+                with open(config_path, 'r', encoding='utf-8') as f:
+                    config = json.load(f)
+            config.update(values)
+            with open(config_path, 'w', encoding='utf-8') as f:
+                json.dump(config, f, ensure_ascii=False, indent=4)
+        except Exception as e:
+            print(f"保存配置文件失败: {str(e)}")
 
     async def initial_update(self):
-        """启动时的初始更新"""
+        """启动时的初始更新, 启动期间只在这里获取一次服务器信息和状态"""
         try:
-            # 先获取服务器信息，因这包含了check_update_before_play的值
-            server_info = await self.get_server_info()
+            server_info, response = await self.refresh_server_status()
             if server_info:
-                # 更新标题
-                title = server_info.get("login_title", "无限魔兽")
-                self.setWindowTitle(title)
-                self.title_label.setText(title)
-                
                 # 确保check_update_before_play被正确设置
                 self.check_update_before_play = int(server_info.get("check_update_before_play", 1))
-                #print(f"初始化时获取到启动前检查更新设置: {self.check_update_before_play}")
-            
-            # 再获取服务器状态
-            response = await self.send_request(Opcodes.SERVER_STATUS)
-            if response:
-                # 更新状态和在线人数
-                server_status = response.get('status', '未知')
-                online_count = response.get('online_count', 0)
-                
-                status = f"服务器状态: {server_status}\n"
-                status += f"在线人数: {online_count}\n\n"
-                status += "公告：\n"
-                
-                # 处理公告内容
-                announcements = response.get('announcements', ['暂无公告'])
-                for announcement in announcements:
-                    status += f"{announcement}\n"
-                    
-                # 立即更新显示
-                self.info_box.setText(status)
-                
         except Exception as e:
             print(f"初始化更新失败: {str(e)}")
-            self.info_box.setText("无法获取服务器信息")
+
+    def load_server_info_cache(self):
+        """显示上次获取的服务器信息, 标记为旧数据, 直到服务器的响应到达"""
+        self.cached_status_text = None
+        try:
+            if not os.path.exists(SERVER_INFO_CACHE_FILE):
+                return
+            with open(SERVER_INFO_CACHE_FILE, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+            if cache.get("api_base_url") != self.api_base_url:
+                return
+            server_info = cache.get("server_info")
+            if server_info:
+                self.update_server_info(server_info)
+                # 服务器信息未变化时只返回304
+                if cache.get("etag"):
+                    self.http.etag_cache[f"{self.api_base_url}/server_info"] = (cache["etag"], server_info)
+            # update_server_info已记录服务器信息中的状态, 有缓存的服务器状态时使用服务器状态
+            if cache.get("server_status"):
+                self.cached_status_text = self.format_server_status(cache["server_status"])
+            if self.cached_status_text:
+                self.info_box.setText("(以下为上次获取的信息, 正在连接服务器...)\n\n" + self.cached_status_text)
+        except Exception as e:
+            print(f"读取服务器信息缓存失败: {str(e)}")
+
+    def save_server_info_cache(self, **values):
+        """保存最新的服务器信息或状态, 下次启动时先显示"""
+        try:
+            cache = {}
+            if os.path.exists(SERVER_INFO_CACHE_FILE):
+                with open(SERVER_INFO_CACHE_FILE, 'r', encoding='utf-8') as f:
+                    cache = json.load(f)
+            if cache.get("api_base_url") != self.api_base_url:
+                cache = {"api_base_url": self.api_base_url}
+            cache.update(values)
+            temp_file = SERVER_INFO_CACHE_FILE + ".tmp"
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(cache, f, ensure_ascii=False)
+            os.replace(temp_file, SERVER_INFO_CACHE_FILE)
+        except Exception as e:
+            print(f"保存服务器信息缓存失败: {str(e)}")
 
     def setup_ui(self):
         # 题文字放大300%
@@ -297,56 +414,54 @@ class WowLauncher(QMainWindow):
         self.shop_btn.clicked.connect(self.open_shop)
         self.update_btn.clicked.connect(self.check_update_clicked)
         self.start_btn.clicked.connect(self.start_game)
-        
-        # 初始化服务器状态
-        self.update_server_status()
 
     async def send_request(self, opcode, data=None):
         """发送网络请求的通用方法"""
+        import aiohttp
         try:
-            async with aiohttp.ClientSession() as session:
-                # 使用配置的 API URL
-                url = f"{self.api_base_url}/api"
-                headers = {
-                    "Content-Type": "application/json",
-                    "Accept": "application/json"
-                }
-                
-                request_data = {
-                    "opcode": int(opcode),
-                    "data": data if data else {}
-                }
+            session = await self.http.get_session()
+            # 使用配置的 API URL
+            url = f"{self.api_base_url}/api"
+            headers = {
+                "Content-Type": "application/json",
+                "Accept": "application/json"
+            }
+            
+            request_data = {
+                "opcode": int(opcode),
+                "data": data if data else {}
+            }
+            
+            print(f"发送请求: {url}")
+            print(f"请求数据: {request_data}")
+            
+            async with session.post(url, 
+                                  json=request_data, 
+                                  headers=headers,
+                                  timeout=aiohttp.ClientTimeout(total=30)) as response:
+                print(f"响应状态: {response.status}")
                 
-                print(f"发送请求: {url}")
-                print(f"请求数据: {request_data}")
+                # 读取响应内容
+                response_text = await response.text()
+                print(f"响应内容: {response_text}")
                 
-                async with session.post(url, 
-                                      json=request_data, 
-                                      headers=headers,
-                                      timeout=30) as response:
-                    print(f"响应状态: {response.status}")
-                    
-                    # 读取响应内容
-                    response_text = await response.text()
-                    print(f"响应内容: {response_text}")
+                if response.status == 200:
+                    return await response.json()
+                else:
+                    # 尝试解析错误响应
+                    try:
+                        error_data = json.loads(response_text)
+                        # 返回错误信息，而不是抛出异常
+                        return {
+                            "success": False,
+                            "detail": error_data.get("detail", "未知错误")
+                        }
+                    except:
+                        return {
+                            "success": False,
+                            "detail": response_text
+                        }
                     
-                    if response.status == 200:
-                        return await response.json()
-                    else:
-                        # 尝试解析错误响应
-                        try:
-                            error_data = json.loads(response_text)
-                            # 返回错误信息，而不是抛出异常
-                            return {
-                                "success": False,
-                                "detail": error_data.get("detail", "未知错误")
-                            }
-                        except:
-                            return {
-                                "success": False,
-                                "detail": response_text
-                            }
-                        
         except asyncio.TimeoutError:
             return {
                 "success": False,
@@ -360,36 +475,99 @@ class WowLauncher(QMainWindow):
             }        
 
 
+    def run_async(self, coro, on_done=None):
+        """在后台事件循环中运行协程, 返回concurrent.futures.Future
+
+        on_done(future)在协程结束后于界面线程中调用。
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        if on_done is not None:
+            future.add_done_callback(lambda f: self.call_in_gui(on_done, f))
+        return future
+
+    def call_in_gui(self, func, *args):
+        """在界面线程中调用func, 后台线程只能通过这里修改界面"""
+        self.gui_call_signal.emit(func, args)
+
+    async def run_blocking(self, func, *args):
+        """在线程池中执行文件哈希等耗时操作, 不阻塞事件循环"""
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    def stop_loop(self):
+        """退出前取消更新, 关闭HTTP会话并停止后台事件循环"""
+        try:
+            if self.update_task is not None:
+                self.loop.call_soon_threadsafe(self.update_task.cancel)
+            self.cancel_deep_verify()
+            self.cancel_staging()
+            asyncio.run_coroutine_threadsafe(self.http.close(), self.loop).result(timeout=3)
+        except Exception as e:
+            print(f"关闭网络连接失败: {str(e)}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join(timeout=3)
+
     def update_server_status(self):
-        """更新服务器状态"""
+        """更新服务器状态, 在后台事件循环中执行"""
+        # 上一次刷新还没有完成时跳过
+        if self.status_future is not None and not self.status_future.done():
+            return
+        self.status_future = self.run_async(self.refresh_server_status())
+
+    def show_offline_status(self):
+        """无法连接服务器时继续显示上次获取的信息, 并标记为离线"""
+        if self.cached_status_text:
+            self.info_box.setText("(无法连接服务器, 以下为上次获取的信息)\n\n" + self.cached_status_text)
+        else:
+            self.info_box.setText("无法获取服务器状态")
+
+    def on_status_timer(self):
+        """定时刷新服务器状态, 登录器在托盘中时顺便预下载待发布版本"""
+        self.update_server_status()
+        self.start_staging()
+
+    async def refresh_server_status(self):
+        """同时获取服务器信息和服务器状态, 先返回的先显示, 返回 (服务器信息, 服务器状态), 失败的为None
+
+        两者都失败时保留界面上的信息, 标记为离线。
+        """
+        server_info = response = None
         try:
-            self.loop.run_until_complete(self._async_update_server_status())
-            # 同时更新服务器信息
-            self.loop.run_until_complete(self.get_server_info())
+            server_info, response = await asyncio.gather(self.get_server_info(), self._async_update_server_status())
         except Exception as e:
             print(f"更新服务器状态失败: {str(e)}")
-            self.info_box.setText("无法获取服务器状态")
+        if not server_info and not response:
+            self.call_in_gui(self.show_offline_status)
+        return server_info, response
+
+    def format_server_status(self, response):
+        """服务器状态和公告的显示内容"""
+        server_status = response.get('status', '未知')
+        online_count = response.get('online_count', 0)
+        
+        status = f"服务器状态: {server_status}\n"
+        status += f"在线人数: {online_count}\n\n"
+        status += "公告：\n"
+        
+        announcements = response.get('announcements', ['暂无公告'])
+        for announcement in announcements:
+            status += f"{announcement}\n"
+        return status
 
     async def _async_update_server_status(self):
-        """异更新服务器状态"""
+        """异步更新服务器状态, 返回服务器的响应, 失败返回None"""
         try:
             response = await self.send_request(Opcodes.SERVER_STATUS)
-            if response:
-                server_status = response.get('status', '未知')
-                online_count = response.get('online_count', 0)
-                
-                status = f"服务器状态: {server_status}\n"
-                status += f"在线人数: {online_count}\n\n"
-                status += "公告：\n"
-                
-                announcements = response.get('announcements', ['暂无公告'])
-                for announcement in announcements:
-                    status += f"{announcement}\n"
-                    
-                self.info_box.setText(status)
+            # 连接失败时send_request返回success为False的错误信息
+            if not response or response.get("success") is False:
+                raise Exception(response.get("detail") if response else "没有响应")
+            status = self.format_server_status(response)
+            self.cached_status_text = status
+            self.call_in_gui(self.info_box.setText, status)
+            self.save_server_info_cache(server_status=response)
+            return response
         except Exception as e:
-            print(f"更新服务器状态失: {str(e)}")
-            self.info_box.setText("无法获取服务器状态")
+            print(f"更新服务器状态失败: {str(e)}")
+            return None
     
     def open_register(self):
         dialog = RegisterDialog(self)
@@ -442,188 +620,827 @@ class WowLauncher(QMainWindow):
         QDesktopServices.openUrl(QUrl("http://your-server.com/shop"))
     
     def check_update_clicked(self):
-        """检查更新按钮点击处理"""
-        # 创建事件循环
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
-        try:
-            # 修改参数名为 passgamecheck
-            loop.run_until_complete(self.check_update())
-        finally:
-            # 关闭事件循环
-            loop.close()
+        """检查更新按钮点击处理, 更新过程中再次点击取消更新"""
+        if self.update_future is not None and not self.update_future.done():
+            self.cancel_update()
+            return
+        self.start_update()
 
-    async def check_update(self):
-        """检查更新"""
-        try:
-            # 显示进度条
-            self.progress.show()
-            self.progress.setValue(0)
+    def start_update(self, launch_after=False):
+        """在后台检查更新, launch_after为True时更新结束后启动游戏
+
+        启动前的检查使用服务器指定的校验模式, 完整校验(deep)在游戏启动后于后台进行;
+        手动检查更新使用标准模式。
+        """
+        if self.update_future is not None and not self.update_future.done():
+            # 已经在更新(例如关键文件更新后启动了游戏, 其余文件还在后台更新), 更新结束后再启动
+            self.launch_after_update = self.launch_after_update or launch_after
+            return
+        # 完整校验和更新同时进行可能读到正在写入的文件, 预下载让出带宽
+        self.cancel_deep_verify()
+        self.cancel_staging()
+        verify_mode = "quick" if launch_after and self.verify_mode == "quick" else "standard"
+        self.launch_after_update = launch_after
+        self.create_rate_limiters()
+        self.update_future = self.run_async(self.check_update(verify_mode), self.on_update_finished)
+
+    def cancel_update(self):
+        """取消正在进行的更新, 已下载的部分保留在.part文件中, 下次继续"""
+        if self.update_task is not None:
             self.update_btn.setEnabled(False)
+            self.log_message("正在取消更新...")
+            self.loop.call_soon_threadsafe(self.update_task.cancel)
+
+    def launch_early(self):
+        """关键文件已更新完成, 不等待其余文件直接启动游戏"""
+        if not self.launch_after_update:
+            return
+        self.launch_after_update = False
+        self.log_message("关键文件已更新, 启动游戏, 其余文件在后台继续更新")
+        self.game_started_during_update = True
+        self.apply_rate_limits()
+        self._launch_game()
+
+    def on_update_finished(self, future):
+        """更新结束(完成、失败或取消)后在界面线程中调用"""
+        self.update_task = None
+        if self.launch_after_update and not future.cancelled():
+            self._launch_game()
+        self.launch_after_update = False
+        if self.game_started_during_update:
+            self.game_started_during_update = False
+            self.apply_rate_limits()
+            # 提前启动游戏时后台还在更新, 完整校验推迟到更新全部成功后开始
+            if (self.verify_mode == "deep" and not future.cancelled() and future.exception() is None
+                    and future.result() and self.is_wow_running()):
+                self.start_deep_verify()
+        # 启动游戏后登录器在托盘中, 更新结束后开始预下载待发布版本
+        self.start_staging()
+
+    def set_updating(self, updating):
+        """切换更新状态: 更新时显示进度条, 检查更新按钮改为取消更新"""
+        if updating:
+            self.progress.setValue(0)
+            self.progress.show()
+            self.update_btn.setText("取消更新")
             self.start_btn.setEnabled(False)
+        else:
+            self.progress.hide()
+            self.update_btn.setText("检查更新")
+            self.start_btn.setEnabled(True)
+        self.update_btn.setEnabled(True)
+
+    async def check_update(self, verify_mode="standard"):
+        """检查更新, verify_mode为本地文件的校验模式(quick/standard)
+
+        启动游戏前的更新在关键文件更新完成后就启动游戏(launch_early), 其余文件在后台继续更新。
+        全部文件都已更新成功时返回True。
+        """
+        from file_manifest import LocalFileIndex, PRIORITIES, PRIORITY_CRITICAL
+        from download_manager import (DownloadJournal, DownloadQueue, Downloader, run_download_workers,
+                                      check_disk_space)
+        # 是否已经在关键文件更新后启动了游戏
+        launched_early = False
+        # 所有文件都已更新到服务器版本时返回True
+        succeeded = False
+        try:
+            # 记录当前任务, 点击取消更新时取消
+            self.update_task = asyncio.current_task()
+            # 显示进度条
+            self.call_in_gui(self.set_updating, True)
             #self.log_message("开始检查更新...")
 
             # 获取客户端根目录
             client_root = os.path.dirname(os.path.abspath(__file__))
             self.log_message(f"客户端目录: {client_root}")
+            if self.file_index is None:
+                self.file_index = LocalFileIndex(client_root, os.path.join(client_root, "local_index.json"))
             
             # 如果游戏正在运行，并且是检查更新，则提示用户关闭游戏
             if self.is_wow_running() > 0:
                 self.log_message("检测到游戏正在运行")
-                self.progress.hide()
-                self.update_btn.setEnabled(True)
-                self.start_btn.setEnabled(True)
-                QMessageBox.warning(self, "错误", "请先关闭游戏客户端再进行更新")
+                self.call_in_gui(self.set_updating, False)
+                self.call_in_gui(QMessageBox.warning, self, "错误", "请先关闭游戏客户端再进行更新")
                 return
 
             # 获取服务器文件列表和更新选项
-            async with aiohttp.ClientSession() as session:
-                # 用配置的 API URL
-                async with session.get(f"{self.api_base_url}/check_update") as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        server_files = data["files"] 
-                        
-                        mpq_whitelist = set(data.get("mpq_whitelist", []))
-                        
-                        #self.log_message(f"获到服务器文件列表: {len(server_files)}个文件")
-                        #self.log_message(f"强制更新WOW.EXE: {'是' if self.force_wow == 1 else '否'}")
-                        #self.log_message(f"强制删除无关MPQ: {'是' if self.force_mpq == 1 else '否'}")
-                        self.log_message(f"启动前检查更新: {'是' if self.check_update_before_play == 1 else '否'}")
-                    else:
-                        raise Exception("获取服务器文件列表失败")
-
-            # 检查本地文件
+            session = await self.http.get_session()
+            server_files, changed_files, mpq_whitelist, new_state = await self.sync_manifest(session, client_root)
+            self.log_message(f"校验模式: {VERIFY_MODE_NAMES.get(verify_mode, verify_mode)}")
+
+            #self.log_message(f"获到服务器文件列表: {len(server_files)}个文件")
+            #self.log_message(f"强制更新WOW.EXE: {'是' if self.force_wow == 1 else '否'}")
+            #self.log_message(f"强制删除无关MPQ: {'是' if self.force_mpq == 1 else '否'}")
+            self.log_message(f"启动前检查更新: {'是' if self.check_update_before_play == 1 else '否'}")
+
+            # 安装方案没有选择的可选内容不同步, 并删除客户端已有的文件, 避免游戏加载过期的版本;
+            # 这些文件仍在服务器白名单中, 不会被当作无关MPQ处理
+            content_tags = self.selected_content_tags()
+            if content_tags is not None:
+                profile = self.current_install_profile()
+                self.log_message(f"安装方案: {profile.get('title', profile.get('name'))}")
+                selected_files = {}
+                for file_path, info in server_files.items():
+                    if not info.get('tags') or content_tags & set(info['tags']):
+                        selected_files[file_path] = info
+                        continue
+                    local_path = self.get_local_path(client_root, file_path)
+                    if os.path.exists(local_path):
+                        try:
+                            os.remove(local_path)
+                            self.log_message(f"删除未选择的可选内容: {file_path}")
+                        except Exception as e:
+                            self.log_message(f"删除文件失败 {file_path}: {str(e)}")
+                server_files = selected_files
+
+            # 检查本地文件, 需要更新的文件立即加入下载队列, 本地校验和下载同时进行
             need_update = []
-            total_size = 0
+            journal = DownloadJournal(os.path.join(client_root, "download_journal.json"))
+            unfinished = journal.unfinished()
+            if unfinished:
+                self.log_message(f"发现 {len(unfinished)} 个未完成的下载, 将继续下载")
+            downloader = Downloader(self.api_base_url, journal, self.log_message,
+                                    segments=self.download_segments, segment_threshold=self.segment_threshold,
+                                    limiter=self.download_limiter)
+            queue = DownloadQueue()
+            downloaded_size = 0
+            progress_value = 0
+            progress_time = 0
 
-            # 处理文件更新
-            for file_path, info in server_files.items():
-                local_path = os.path.join(client_root, file_path)
-                
-                # 处理Wow目录下的文件
-                if file_path.startswith("Wow/"):
-                    if self.force_wow == 1:
-                        # 强制更新Wow目录的文件,但需要检查hash
-                        target_path = os.path.join(client_root, file_path.replace("Wow/", ""))
-                        if not os.path.exists(target_path) or await self.get_file_hash(Path(target_path)) != info['hash']:
-                            self.log_message(f"添加Wow目录文件到更新列表: {file_path}")
-                            need_update.append((file_path, target_path))
-                            total_size += info['size']
-                    continue
+            def on_progress(size):
+                nonlocal downloaded_size, progress_value, progress_time
+                downloaded_size += size
+                # 百分比变化时才通知界面, 并且每秒最多PROGRESS_FPS次; 校验期间总大小还在增加
+                value = min(100, int((downloaded_size / max(queue.total_size, 1)) * 100))
+                now = time.monotonic()
+                if value != progress_value and (value == 100 or now - progress_time >= 1 / PROGRESS_FPS):
+                    progress_value = value
+                    progress_time = now
+                    self.call_in_gui(self.progress.setValue, value)
+
+            # 已加入队列还没开始更新的文件完成后净增加的磁盘空间, 开始下载的文件已预分配空间
+            waiting_space = 0
+            # 启动游戏时, 关键文件全部校验完成且需要更新的都已更新后即可启动, 其余文件在后台继续更新
+            critical_waiting = 0
+            critical_checked = False
+            failed = []
 
-                # 处理Data目录下的文件
-                if file_path.startswith("Data/"):
+            def check_critical_ready():
+                nonlocal launched_early
+                if (critical_checked and critical_waiting == 0 and not launched_early
+                        and self.launch_after_update):
+                    launched_early = True
+                    # 启动游戏前先删除无关MPQ, 避免被游戏加载
                     if self.force_mpq == 1:
-                        # 检查是否在白名单中
-                        file_name = os.path.basename(file_path).lower()
-                        if file_name in mpq_whitelist:
-                            if not os.path.exists(local_path) or await self.get_file_hash(Path(local_path)) != info['hash']:
-                                self.log_message(f"添加白名单MPQ文件到更新列表: {file_path}")
-                                need_update.append((file_path, local_path))
-                                total_size += info['size']
+                        self.remove_unlisted_mpqs(client_root, mpq_whitelist)
+                    self.call_in_gui(self.launch_early)
+
+            async def update_job(job):
+                nonlocal waiting_space, critical_waiting
+                server_path, local_path, space, priority = job
+                waiting_space -= space
+                try:
+                    await self.update_file(session, downloader, server_path, local_path,
+                                           server_files[server_path], on_progress)
+                except Exception as e:
+                    self.log_message(f"下载文件 {server_path} 失败: {str(e)}")
+                    if not launched_early:
+                        raise
+                    # 游戏已启动, 其余文件失败时(例如文件正在被游戏使用)不影响其他文件, 下次启动时继续
+                    failed.append(server_path)
+                    return
+                if priority == PRIORITY_CRITICAL:
+                    critical_waiting -= 1
+                    check_critical_ready()
+
+            async def add_update(file_path, local_path, info):
+                nonlocal waiting_space, critical_waiting
+                # 可用空间不足时立即停止, 不要下载到一半才失败
+                space, temporary = self.update_space_needed(downloader, local_path, info)
+                check_disk_space(client_root, waiting_space + space + temporary)
+                waiting_space += space
+                priority = self.file_priority(info)
+                if priority == PRIORITY_CRITICAL:
+                    critical_waiting += 1
+                need_update.append((file_path, local_path))
+                await queue.put(info['size'], (file_path, local_path, space, priority), priority)
+
+            # 所有文件共用保持连接的会话, 同时下载多个文件
+            download_task = asyncio.create_task(run_download_workers(queue, update_job, self.parallel_downloads))
+            try:
+                # 处理文件更新, 按优先级校验, 关键文件最先校验和下载
+                for file_path, info in sorted(server_files.items(),
+                                              key=lambda item: PRIORITIES.index(self.file_priority(item[1]))):
+                    # 下载出错时停止校验
+                    if download_task.done():
+                        break
+                    if not critical_checked and self.file_priority(info) != PRIORITY_CRITICAL:
+                        critical_checked = True
+                        check_critical_ready()
+                    local_path = os.path.join(client_root, file_path)
+                    # 服务器上有变化的文件总是按标准模式校验, 避免大小相同的新版本被跳过
+                    file_mode = "standard" if file_path in changed_files else verify_mode
+                
+                    # 处理Wow目录下的文件
+                    if file_path.startswith("Wow/"):
+                        if self.force_wow == 1:
+                            # 强制更新Wow目录的文件,但需要检查hash
+                            target_path = os.path.join(client_root, file_path.replace("Wow/", ""))
+                            if await self.file_needs_update(target_path, info, file_mode):
+                                self.log_message(f"添加Wow目录文件到更新列表: {file_path}")
+                                await add_update(file_path, target_path, info)
+                        continue
+
+                    # 处理Data目录下的文件
+                    if file_path.startswith("Data/"):
+                        if self.force_mpq == 1:
+                            # 检查是否在白名单中
+                            file_name = os.path.basename(file_path).lower()
+                            if file_name in mpq_whitelist:
+                                if await self.file_needs_update(local_path, info, file_mode):
+                                    self.log_message(f"添加白名单MPQ文件到更新列表: {file_path}")
+                                    await add_update(file_path, local_path, info)
+                            else:
+                                # 删除不在白名单中的MPQ文件
+                                if os.path.exists(local_path):
+                                    try:
+                                        os.remove(local_path)
+                                        self.log_message(f"删除非白名单MPQ文件: {file_path}")
+                                    except Exception as e:
+                                        self.log_message(f"删除文件失败 {file_path}: {str(e)}")
                         else:
-                            # 删除不在白名单中的MPQ文件
-                            if os.path.exists(local_path):
-                                try:
-                                    os.remove(local_path)
-                                    self.log_message(f"删除非白名单MPQ文件: {file_path}")
-                                except Exception as e:
-                                    self.log_message(f"删除文件失败 {file_path}: {str(e)}")
-                    else:
-                        # 不检查白名单，只同步文件
-                        if not os.path.exists(local_path) or await self.get_file_hash(Path(local_path)) != info['hash']:
-                            self.log_message(f"添加Data目录文件到更新列表: {file_path}")
-                            need_update.append((file_path, local_path))
-                            total_size += info['size']
+                            # 不检查白名单，只同步文件
+                            if await self.file_needs_update(local_path, info, file_mode):
+                                self.log_message(f"添加Data目录文件到更新列表: {file_path}")
+                                await add_update(file_path, local_path, info)
+            except BaseException:
+                download_task.cancel()
+                await asyncio.gather(download_task, return_exceptions=True)
+                downloader.close()
+                raise
+            await queue.close()
+            if not critical_checked:
+                critical_checked = True
+                check_critical_ready()
+
+            # 先保存本次计算的文件哈希, 下载过程中中断也不需要重新计算
+            self.file_index.save()
+
+            if need_update:
+                self.log_message(f"需要更新 {len(need_update)} 个文件")
+            # 等待剩余的文件下载完成
+            try:
+                await download_task
+            finally:
+                downloader.close()
 
             if not need_update:
-                self.progress.hide()
-                self.update_btn.setEnabled(True)
-                self.start_btn.setEnabled(True)
+                # 清理上次中断后已不再需要的.part文件
+                journal.clear()
+                self.save_update_state(client_root, new_state)
+                self.call_in_gui(self.set_updating, False)
                 self.log_message("客户端已是最新版本")
                 #QMessageBox.information(self, "更新", "客户端已是最新版本")
+                return True
+
+            if failed:
+                # 不保存同步状态, 下次检查更新时重新校验这些文件
+                self.call_in_gui(self.set_updating, False)
+                self.log_message(f"{len(failed)} 个文件未能更新, 将在下次启动时继续更新")
                 return
 
-            # 开始下载需要更新的文件
-            self.log_message(f"需要更新 {len(need_update)} 个文件")
-            downloaded_size = 0
-            for server_path, local_path in need_update:
+            journal.clear()
+            self.save_update_state(client_root, new_state)
+            # 已发布的预下载文件都已替换到位, 剩下的只保留仍属于待发布版本的文件
+            if self.pending_hashes is not None:
+                self.clean_stage_dir(self.pending_hashes)
+            self.call_in_gui(self.set_updating, False)
+            self.log_message("更新完成")
+            succeeded = True
+            if not launched_early:
+                self.call_in_gui(QMessageBox.information, self, "更新", "更新完成")
+
+        except asyncio.CancelledError:
+            self.log_message("更新已取消, 已下载的部分下次继续")
+            self.call_in_gui(self.set_updating, False)
+            raise
+        except Exception as e:
+            self.log_message(f"更新失败: {str(e)}")
+            self.call_in_gui(self.set_updating, False)
+            self.call_in_gui(QMessageBox.warning, self, "错误", f"更新失败: {str(e)}")
+        finally:
+            # 保存下载后记录的文件哈希
+            if self.file_index is not None:
+                self.file_index.save()
+
+        if self.force_mpq == 1 and not launched_early:
+            self.remove_unlisted_mpqs(client_root, mpq_whitelist)
+        return succeeded
+
+    def get_stage_dir(self):
+        """预下载目录, 文件以MD5命名, 和游戏文件在同一磁盘上, 可以直接替换"""
+        return os.path.join(os.path.dirname(os.path.abspath(__file__)), "Staging")
+
+    def update_space_needed(self, downloader, local_path, info):
+        """按update_file使用的更新方式估计磁盘空间, 返回 (更新完成后净增加的空间, 更新过程中临时额外占用的空间)
+
+        已预先下载的文件只需改名, 不需要空间。其他方式都先生成完整的新文件再替换旧文件:
+        完成后净增加新旧文件的大小差, 替换前旧文件(差异更新时还有差异文件)临时占用空间。
+        """
+        staged_path = os.path.join(self.get_stage_dir(), info['hash'])
+        if os.path.exists(staged_path) and os.path.getsize(staged_path) == info['size']:
+            return 0, 0
+        old_size = os.path.getsize(local_path) if os.path.exists(local_path) else 0
+        temporary = old_size
+        local_hash = self.file_index.lookup(local_path) if self.file_index else None
+        if local_hash and local_hash[0] in info.get('deltas', {}):
+            temporary += info['deltas'][local_hash[0]]
+        return max(0, downloader.space_needed(local_path, info) - old_size), temporary
+
+    def install_staged_file(self, server_path, local_path, info):
+        """预下载目录中有这个版本的文件时替换到local_path, 返回是否已替换"""
+        staged_path = os.path.join(self.get_stage_dir(), info['hash'])
+        try:
+            if not os.path.exists(staged_path) or os.path.getsize(staged_path) != info['size']:
+                return False
+            os.replace(staged_path, local_path)
+            self.log_message(f"使用预先下载的文件: {server_path}")
+            return True
+        except OSError as e:
+            self.log_message(f"替换预先下载的文件失败 {server_path}: {str(e)}")
+            return False
+
+    def clean_stage_dir(self, keep_hashes):
+        """删除预下载目录中不属于keep_hashes的文件, 没有需要保留的文件时删除整个目录"""
+        stage_dir = self.get_stage_dir()
+        if not os.path.isdir(stage_dir):
+            return
+        if not keep_hashes:
+            shutil.rmtree(stage_dir, ignore_errors=True)
+            return
+        for name in os.listdir(stage_dir):
+            if name == "journal.json" or name.split('.')[0] in keep_hashes:
+                continue
+            try:
+                os.remove(os.path.join(stage_dir, name))
+            except OSError as e:
+                self.log_message(f"删除过期的预下载文件失败 {name}: {str(e)}")
+
+    def start_staging(self):
+        """登录器在托盘中时在后台预下载待发布版本, 正在更新或预下载时不重复启动"""
+        if not self.in_tray:
+            return
+        if self.update_future is not None and not self.update_future.done():
+            return
+        if self.staging_future is not None and not self.staging_future.done():
+            return
+        self.create_rate_limiters()
+        self.staging_future = self.run_async(self.stage_pending_release())
+
+    def cancel_staging(self):
+        if self.staging_future is not None and not self.staging_future.done():
+            self.staging_future.cancel()
+
+    async def stage_pending_release(self):
+        """把服务器待发布版本中本地还没有的文件下载到预下载目录
+
+        只用一个连接依次下载, 不影响游戏。发布后检查更新时, 需要更新的文件直接从预下载目录替换。
+        """
+        from file_manifest import LocalFileIndex
+        from download_manager import DownloadJournal, Downloader
+        try:
+            data = await self.http.fetch_json(f"{self.api_base_url}/pending/manifest")
+            if data is None:
+                return
+            files = data.get("files", {})
+            # 没有待发布版本时不删除预下载的文件, 可能刚刚发布, 下次更新时使用
+            self.pending_hashes = {info['hash'] for info in files.values()}
+            if not files:
+                return
+
+            client_root = os.path.dirname(os.path.abspath(__file__))
+            if self.file_index is None:
+                self.file_index = LocalFileIndex(client_root, os.path.join(client_root, "local_index.json"))
+            stage_dir = self.get_stage_dir()
+            os.makedirs(stage_dir, exist_ok=True)
+            self.clean_stage_dir(self.pending_hashes)
+
+            content_tags = self.selected_content_tags()
+            journal = DownloadJournal(os.path.join(stage_dir, "journal.json"))
+            downloader = Downloader(f"{self.api_base_url}/pending", journal, self.log_message,
+                                    limiter=self.staging_limiter)
+            session = await self.http.get_session()
+            staged = 0
+            try:
+                for file_path, info in files.items():
+                    if content_tags is not None and info.get('tags') and not content_tags & set(info['tags']):
+                        continue
+                    staged_path = os.path.join(stage_dir, info['hash'])
+                    if os.path.exists(staged_path):
+                        continue
+                    # 本地已经是这个版本的文件不需要预下载
+                    local_path = self.get_local_path(client_root, file_path)
+                    if not await self.file_needs_update(local_path, info, "standard"):
+                        continue
+                    if staged == 0:
+                        self.log_message("发现待发布的新版本, 开始在后台预先下载")
+                    await downloader.download(session, file_path, staged_path, info)
+                    staged += 1
+            finally:
+                downloader.close()
+                self.file_index.save()
+            if staged:
+                journal.clear()
+                self.log_message(f"已预先下载新版本的 {staged} 个文件, 发布后更新时直接替换")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.log_message(f"预下载新版本失败: {str(e)}")
+
+    def file_priority(self, info):
+        """清单中文件的更新优先级, 没有或无法识别时为normal"""
+        from file_manifest import PRIORITIES, PRIORITY_NORMAL
+        priority = info.get('priority')
+        return priority if priority in PRIORITIES else PRIORITY_NORMAL
+
+    def remove_unlisted_mpqs(self, client_root, mpq_whitelist):
+        """删除客户端Data目录下不在白名单中的MPQ文件"""
+        self.log_message("检查无关MPQ文件...")
+        data_dir = os.path.join(client_root, "Data")
+        if os.path.exists(data_dir):
+            # 获取客户端Data目录下所有MPQ文件
+            client_mpq_files = [f for f in os.listdir(data_dir) if f.lower().endswith('.mpq')]
+            self.log_message(f"客户端MPQ文件: {client_mpq_files}")
+            self.log_message(f"白名单MPQ文件: {mpq_whitelist}")
+            
+            # 检查每个MPQ文件
+            for mpq_file in client_mpq_files:
+                mpq_file_lower = mpq_file.lower()
+                if mpq_file_lower not in mpq_whitelist:
+                    full_path = os.path.join(data_dir, mpq_file)
+                    try:
+                        os.remove(full_path)
+                        self.log_message(f"删除非白名单MPQ文件: {mpq_file}")
+                    except Exception as e:
+                        self.log_message(f"删除文件失败 {mpq_file}: {str(e)}")
+
+    async def update_file(self, session, downloader, server_path, local_path, info, on_progress):
+        """更新单个文件: 继续上次中断的下载, 否则依次尝试差异文件、只下载不同的块、完整下载"""
+        from file_manifest import BLOCK_SIZE
+        self.log_message(f"正在更新: {server_path}")
+
+        # 确保目录存在
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+
+        # 后台已经预先下载了这个版本时直接替换
+        if self.install_staged_file(server_path, local_path, info):
+            on_progress(info['size'])
+        # 上次中断的下载直接续传
+        elif downloader.resume_offset(server_path, local_path, info) > 0:
+            await downloader.download(session, server_path, local_path, info, on_progress)
+        else:
+            # 本地已有旧版本的大文件时, 优先使用服务器生成的差异文件, 其次只下载不同的块
+            local_hash = self.file_index.lookup(local_path)
+            if (local_hash and local_hash[0] in info.get('deltas', {})
+                    and await self.apply_file_delta(session, downloader, server_path, local_path, info, local_hash[0])):
+                on_progress(info['size'])
+            elif (os.path.exists(local_path) and info['size'] >= 2 * BLOCK_SIZE
+                    and await self.patch_file_blocks(session, downloader, server_path, local_path, info)):
+                on_progress(info['size'])
+            else:
+                self.log_message(f"开始下载到: {local_path}")
+                await downloader.download(session, server_path, local_path, info, on_progress)
+        self.log_message(f"文件下载完成: {server_path}")
+        # 记录新文件的哈希, 下次检查更新时不需要重新计算
+        self.file_index.update(local_path, self.file_index.stat_key(local_path), info['hash'])
+
+    async def sync_manifest(self, session, client_root):
+        """同步服务器文件清单, 返回 (服务器文件, 上次同步后变化的文件, MPQ白名单, 同步后的状态)
+
+        没有同步记录时获取完整清单; 否则先比较哈希树根哈希, 相同则服务器没有变化;
+        不同时优先请求版本增量, 服务器变更记录无法覆盖时沿哈希树只下载变化的目录。
+        """
+        from file_manifest import build_tree
+        state = self.load_update_state(client_root)
+        if not state:
+            data = await self.http.fetch_json(f"{self.api_base_url}/check_update")
+            if not data:
+                raise Exception("获取服务器文件列表失败")
+            new_state = {
+                "manifest_id": data.get("manifest_id"),
+                "generation": data.get("generation", 0),
+                "config_key": data.get("config_key"),
+                "files": data["files"]
+            }
+            return data["files"], set(data["files"]), set(data.get("mpq_whitelist", [])), new_state
+
+        async with session.get(f"{self.api_base_url}/manifest/root") as response:
+            if response.status != 200:
+                raise Exception("获取服务器文件列表失败")
+            root = await response.json()
+        mpq_whitelist = set(root.get("mpq_whitelist", []))
+        mirror_files = dict(state.get("files", {}))
+        local_tree = build_tree(mirror_files)
+
+        if root["root_hash"] == local_tree[""]["hash"]:
+            # 根哈希相同, 服务器文件没有变化
+            self.log_message("服务器文件没有变化")
+            changed_files = {}
+        elif (root.get("manifest_id") == state.get("manifest_id")
+              and root.get("config_key") == state.get("config_key")
+              and root.get("change_log_start", 0) <= state.get("generation", 0) <= root.get("generation", 0)):
+            # 只请求上次同步之后变化的文件
+            url = f"{self.api_base_url}/check_update?" + urllib.parse.urlencode({
+                "since": state.get("generation", 0),
+                "manifest_id": state.get("manifest_id", ""),
+                "config_key": state.get("config_key", "")
+            })
+            data = await self.http.fetch_json(url)
+            if not data:
+                raise Exception("获取服务器文件列表失败")
+            mpq_whitelist = set(data.get("mpq_whitelist", []))
+            if data.get("delta"):
+                for file_path in data.get("removed", []):
+                    mirror_files.pop(file_path, None)
+                mirror_files.update(data["files"])
+                changed_files = dict(data["files"])
+                self.log_message(f"服务器文件变化: {len(data['files'])}个, 删除: {len(data.get('removed', []))}个")
+            else:
+                mirror_files = data["files"]
+                changed_files = dict(data["files"])
+            root["generation"] = data.get("generation", root.get("generation", 0))
+        else:
+            # 沿哈希树向下, 只获取哈希不同的目录
+            changed_files, removed = await self.fetch_changed_tree(session, local_tree, "")
+            for file_path in removed:
+                mirror_files.pop(file_path, None)
+            mirror_files.update(changed_files)
+            self.log_message(f"服务器文件变化: {len(changed_files)}个, 删除: {len(removed)}个")
+
+        new_state = {
+            "manifest_id": root.get("manifest_id"),
+            "generation": root.get("generation", 0),
+            "config_key": root.get("config_key"),
+            "files": mirror_files
+        }
+        return mirror_files, set(changed_files), mpq_whitelist, new_state
+
+    async def fetch_changed_tree(self, session, local_tree, dir_path):
+        """比较服务器目录节点和本地哈希树, 返回 (变化的文件, 已删除的文件)"""
+        url = f"{self.api_base_url}/manifest/tree?" + urllib.parse.urlencode({"path": dir_path})
+        node = await self.http.fetch_json(url)
+        if node is None:
+            raise Exception(f"获取服务器目录失败: {dir_path}")
+
+        local_node = local_tree.get(dir_path, {"dirs": {}, "files": {}})
+        prefix = f"{dir_path}/" if dir_path else ""
+        changed_files = {}
+        removed = []
+
+        for name, info in node["files"].items():
+            if local_node["files"].get(name) != info:
+                changed_files[prefix + name] = info
+        for name in local_node["files"]:
+            if name not in node["files"]:
+                removed.append(prefix + name)
+
+        # 服务器上已不存在的目录, 其中的文件全部删除
+        for name in local_node["dirs"]:
+            if name not in node["dirs"]:
+                removed_dir = prefix + name
+                for path, child in local_tree.items():
+                    if path == removed_dir or path.startswith(removed_dir + "/"):
+                        removed.extend(f"{path}/{file_name}" for file_name in child["files"])
+
+        # 哈希不同的子目录并发向下比较
+        subdirs = [prefix + name for name, dir_hash in node["dirs"].items()
+                   if local_node["dirs"].get(name) != dir_hash]
+        for sub_changed, sub_removed in await asyncio.gather(
+                *(self.fetch_changed_tree(session, local_tree, subdir) for subdir in subdirs)):
+            changed_files.update(sub_changed)
+            removed.extend(sub_removed)
+
+        return changed_files, removed
+
+    def get_local_path(self, client_root, file_path):
+        """服务器文件对应的本地路径, Wow目录下的文件放在客户端根目录"""
+        if file_path.startswith("Wow/"):
+            return os.path.join(client_root, file_path[len("Wow/"):])
+        return os.path.join(client_root, file_path)
+
+    def load_update_state(self, client_root):
+        """读取上次成功同步时的清单版本号和服务器清单副本"""
+        try:
+            with open(os.path.join(client_root, "update_state.json"), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception:
+            return None
+
+    def save_update_state(self, client_root, state):
+        """保存同步完成后的清单状态, 下次检查更新时只请求之后的变化"""
+        try:
+            state_path = os.path.join(client_root, "update_state.json")
+            with open(state_path + ".tmp", 'w', encoding='utf-8') as f:
+                json.dump(state, f, ensure_ascii=False)
+            os.replace(state_path + ".tmp", state_path)
+        except Exception as e:
+            print(f"保存更新状态失败: {str(e)}")
+
+    async def apply_file_delta(self, session, downloader, server_path, local_path, info, local_hash):
+        """下载从本地版本到服务器版本的差异文件并应用, 校验通过后替换本地文件, 成功返回True
+
+        差异文件由下载器的写入线程写入, 生成新文件和计算MD5在线程池中进行, 都不占用事件循环。
+        新文件先写入.new文件, 大小和MD5与清单一致才替换本地文件。
+        """
+        from file_manifest import apply_delta
+        delta_path = local_path + ".delta"
+        new_path = local_path + ".new"
+        try:
+            self.log_message(f"差异更新: {server_path}, 差异文件 {info['deltas'][local_hash] / 1024 / 1024:.1f} MB")
+            url = f"{self.api_base_url}/download_delta/{urllib.parse.quote(server_path)}?" + urllib.parse.urlencode({
+                "base": local_hash
+            })
+            async with session.get(url) as response:
+                if response.status != 200:
+                    self.log_message(f"下载差异文件失败 ({response.status}): {server_path}")
+                    return False
+                handle = downloader.writer.open(delta_path, 'wb')
                 try:
-                    self.log_message(f"正在更新: {server_path}")
-                    
-                    # 确保目录存在
-                    os.makedirs(os.path.dirname(local_path), exist_ok=True)
-
-                    # 下载文件
-                    async with aiohttp.ClientSession() as session:
-                        encoded_path = urllib.parse.quote(server_path)
-                        url = f"{self.api_base_url}/download/{encoded_path}"
-                        self.log_message(f"下载URL: {url}")
-                        
-                        async with session.get(url) as response:
-                            if response.status == 200:
-                                self.log_message(f"开始下载到: {local_path}")
-                                with open(local_path, 'wb') as f:
-                                    while True:
-                                        chunk = await response.content.read(8192)
-                                        if not chunk:
-                                            break
-                                        f.write(chunk)
-                                        downloaded_size += len(chunk)
-                                        progress = int((downloaded_size / total_size) * 100)
-                                        self.progress.setValue(progress)
-                                self.log_message(f"文件下载完成: {server_path}")
-                            else:
-                                error_text = await response.text()
-                                raise Exception(f"下载失败 ({response.status}): {error_text}")
+                    while True:
+                        chunk = await downloader.read(response, 65536)
+                        if not chunk:
+                            break
+                        await downloader.writer.write(handle, None, chunk)
+                finally:
+                    await downloader.writer.close(handle)
 
-                except Exception as e:
-                    self.log_message(f"下载文件 {server_path} 失败: {str(e)}")
-                    raise
+            new_hash = await self.run_blocking(apply_delta, delta_path, local_path, new_path)
+            if new_hash != info["hash"] or os.path.getsize(new_path) != info["size"]:
+                self.log_message(f"差异更新后校验失败, 改为完整下载: {server_path}")
+                return False
+            os.replace(new_path, local_path)
+            return True
 
-            self.progress.hide()
-            self.update_btn.setEnabled(True)
-            self.start_btn.setEnabled(True)
-            self.log_message("更新完成")
-            QMessageBox.information(self, "更新", "更新完成")
+        except Exception as e:
+            self.log_message(f"差异更新失败 {server_path}: {str(e)}")
+            return False
+        finally:
+            for temp_path in (delta_path, new_path):
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+
+    async def patch_file_blocks(self, session, downloader, server_path, local_path, info):
+        """按块比较本地文件和服务器文件, 只下载内容不同的块
+
+        不同的块由下载器的写入线程写入本地文件的副本(.part文件), 校验整个文件的MD5后才替换本地文件,
+        中途失败时本地文件保持不变。成功返回True; 不适合分块更新或失败时返回False, 由调用方改为完整下载。
+        """
+        from file_manifest import hash_file, hash_file_blocks, BLOCK_SIZE
+        part_path = downloader.part_path(local_path)
+        try:
+            encoded_path = urllib.parse.quote(server_path)
+            remote = await self.http.fetch_json(f"{self.api_base_url}/manifest/blocks/{encoded_path}")
+            if not remote or remote["hash"] != info["hash"] or not remote["blocks"]:
+                return False
+
+            block_size = remote["block_size"]
+            local_hash = self.file_index.lookup(local_path)
+            if local_hash is None or local_hash[1] is None or block_size != BLOCK_SIZE:
+                local_hash = await self.run_blocking(hash_file_blocks, local_path, block_size)
+            local_blocks = local_hash[1]
+
+            # 找出不同的块, 连续的块合并为一次请求
+            runs = []
+            for index, block in enumerate(remote["blocks"]):
+                if index < len(local_blocks) and local_blocks[index] == block:
+                    continue
+                if runs and runs[-1][0] + runs[-1][1] == index:
+                    runs[-1][1] += 1
+                else:
+                    runs.append([index, 1])
+
+            changed_blocks = sum(count for _, count in runs)
+            if changed_blocks > len(remote["blocks"]) * 0.8:
+                # 大部分内容都不同, 直接完整下载更快
+                return False
+            self.log_message(f"分块更新: {server_path}, 需要下载 {changed_blocks}/{len(remote['blocks'])} 个块")
+
+            await self.run_blocking(shutil.copyfile, local_path, part_path)
+            handle = downloader.writer.open(part_path, 'r+b')
+            try:
+                for start, count in runs:
+                    url = f"{self.api_base_url}/download_blocks/{encoded_path}?" + urllib.parse.urlencode({
+                        "hash": info["hash"],
+                        "start": start,
+                        "count": count
+                    })
+                    async with session.get(url) as response:
+                        if response.status != 200:
+                            self.log_message(f"下载文件分块失败 ({response.status}): {server_path}")
+                            return False
+                        position = start * block_size
+                        expected = min(count * block_size, info["size"] - position)
+                        while True:
+                            chunk = await downloader.read(response, 65536)
+                            if not chunk:
+                                break
+                            await downloader.writer.write(handle, position, chunk)
+                            position += len(chunk)
+                        if position - start * block_size != expected:
+                            self.log_message(f"文件分块不完整, 改为完整下载: {server_path}")
+                            return False
+            finally:
+                await downloader.writer.close(handle)
+            await self.run_blocking(os.truncate, part_path, info["size"])
+
+            if await self.run_blocking(hash_file, part_path) != info["hash"]:
+                self.log_message(f"分块更新后校验失败, 改为完整下载: {server_path}")
+                return False
+            os.replace(part_path, local_path)
+            return True
 
         except Exception as e:
-            self.log_message(f"更新失败: {str(e)}")
-            self.progress.hide()
-            self.update_btn.setEnabled(True)
-            self.start_btn.setEnabled(True)
-            QMessageBox.warning(self, "错误", f"更新失败: {str(e)}")
-
-        if self.force_mpq == 1:
-            self.log_message("检查无关MPQ文件...")
-            data_dir = os.path.join(client_root, "Data")
-            if os.path.exists(data_dir):
-                # 获取客户端Data目录下所有MPQ文件
-                client_mpq_files = [f for f in os.listdir(data_dir) if f.lower().endswith('.mpq')]
-                self.log_message(f"客户端MPQ文件: {client_mpq_files}")
-                self.log_message(f"白名单MPQ文件: {mpq_whitelist}")
-                
-                # 检查每个MPQ文件
-                for mpq_file in client_mpq_files:
-                    mpq_file_lower = mpq_file.lower()
-                    if mpq_file_lower not in mpq_whitelist:
-                        full_path = os.path.join(data_dir, mpq_file)
-                        try:
-                            os.remove(full_path)
-                            self.log_message(f"删除非白名单MPQ文件: {mpq_file}")
-                        except Exception as e:
-                            self.log_message(f"删除文件失败 {mpq_file}: {str(e)}")
+            self.log_message(f"分块更新失败 {server_path}: {str(e)}")
+            return False
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+
+    async def file_needs_update(self, local_path, info, verify_mode):
+        """按校验模式判断本地文件是否需要更新
+
+        quick只比较文件大小和索引中已有的哈希, 不读取文件; standard在文件状态变化时重新计算哈希。
+        后台完整校验发现损坏的文件总是需要更新。
+        """
+        if not os.path.exists(local_path):
+            return True
+        if self.file_index.needs_repair(local_path):
+            self.log_message(f"修复完整校验发现的损坏文件: {local_path}")
+            return True
+        if verify_mode == "quick":
+            if os.path.getsize(local_path) != info['size']:
+                return True
+            cached = self.file_index.lookup(local_path)
+            return cached is not None and cached[0] != info['hash']
+        return await self.get_file_hash(Path(local_path)) != info['hash']
+
+    async def deep_verify(self):
+        """后台完整校验: 重新计算所有本地文件的哈希, 发现损坏的文件记录到索引中, 下次检查更新时修复"""
+        from file_manifest import LocalFileIndex, hash_file_blocks
+        client_root = os.path.dirname(os.path.abspath(__file__))
+        state = self.load_update_state(client_root)
+        if not state:
+            return
+        if self.file_index is None:
+            self.file_index = LocalFileIndex(client_root, os.path.join(client_root, "local_index.json"))
+
+        self.log_message("开始后台完整校验...")
+        damaged = 0
+        try:
+            for file_path, info in state.get("files", {}).items():
+                local_path = self.get_local_path(client_root, file_path)
+                if not os.path.exists(local_path):
+                    continue
+                key = self.file_index.stat_key(local_path)
+                md5_hash, blocks = await self.run_blocking(hash_file_blocks, local_path)
+                self.file_index.update(local_path, key, md5_hash, blocks)
+                if md5_hash != info['hash']:
+                    self.file_index.mark_repair(local_path)
+                    damaged += 1
+                    self.log_message(f"完整校验发现文件损坏: {file_path}")
+        finally:
+            self.file_index.save()
+        if damaged:
+            self.log_message(f"后台完整校验完成, {damaged} 个文件将在下次启动前修复")
+        else:
+            self.log_message("后台完整校验完成, 没有发现损坏的文件")
+
+    def start_deep_verify(self):
+        """游戏运行期间在后台进行完整校验, 后台还在更新时不校验"""
+        if self.verify_future is not None and not self.verify_future.done():
+            return
+        if self.update_future is not None and not self.update_future.done():
+            return
+        self.verify_future = self.run_async(self.deep_verify())
+
+    def cancel_deep_verify(self):
+        if self.verify_future is not None and not self.verify_future.done():
+            self.verify_future.cancel()
 
     async def get_file_hash(self, filepath):
-        """获取文件的MD5哈希值"""
+        """获取文件的MD5哈希值, 同时记录分块校验供分块更新使用
+
+        文件状态(大小、修改时间)和本地索引一致时直接使用索引中的哈希, 不读取文件。
+        """
+        from file_manifest import hash_file_blocks
         try:
-            md5_hash = hashlib.md5()
-            with open(filepath, 'rb') as f:
-                for chunk in iter(lambda: f.read(4096), b''):
-                    md5_hash.update(chunk)
-            return md5_hash.hexdigest()
+            cached = self.file_index.lookup(filepath)
+            if cached is not None:
+                return cached[0]
+            key = self.file_index.stat_key(filepath)
+            md5_hash, blocks = await self.run_blocking(hash_file_blocks, filepath)
+            self.file_index.update(filepath, key, md5_hash, blocks)
+            return md5_hash
         except Exception as e:
             self.log_message(f"计算文件哈希失败 {filepath}: {str(e)}")
             return None
@@ -667,17 +1484,8 @@ class WowLauncher(QMainWindow):
             # 3. 如果没有进程在运行,且需要检查更新
             if wow_process_count == 0 and int(self.check_update_before_play) == 1:
                 print("无游戏进程运行,且启动前检查更新已开启,开始检查更新...")
-                # 创建事件循环
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                
-                try:
-                    # 运行检查更新
-                    loop.run_until_complete(self.check_update())
-                    # 检查更新完成后再启动游戏
-                    self._launch_game()
-                finally:
-                    loop.close()
+                # 在后台检查更新, 完成后再启动游戏
+                self.start_update(launch_after=True)
             else:
                 # 4. 无进程运行,且不需要检查更新,直接启动
                 print("无游戏进程运行,且启动前检查更新已关闭,直接启动游戏...")
@@ -689,21 +1497,21 @@ class WowLauncher(QMainWindow):
             
     def _restore_start_button(self, original_style, original_text):
         """恢复开始游戏按钮的状态并最小化到托盘"""
+        # 还在等待启动前的更新(关键文件)时稍后再恢复
+        if self.launch_after_update:
+            QTimer.singleShot(1000, lambda: self._restore_start_button(original_style, original_text))
+            return
         self.start_btn.setEnabled(True)
         self.start_btn.setStyleSheet(original_style)
         self.start_btn.setText(original_text)
         # 隐藏窗口而不是最小化
-        self.hide()
-        # 显示托盘通知
-        self.tray_icon.showMessage(
-            self.windowTitle(),
-            "游戏启动完成，登录器已最小化到系统托盘",
-            QSystemTrayIcon.Information,
-            2000
-        )
+        self.hide_to_tray("游戏启动完成，登录器已最小化到系统托盘")
 
     def inject_dll(self, process_handle, dll_path):
         """将DLL注入到目标进程"""
+        from ctypes import WinDLL, WINFUNCTYPE, byref, c_ulong
+        from ctypes.wintypes import DWORD, LPVOID
+        import win32con
         try:
             kernel32 = WinDLL('kernel32', use_last_error=True)
             
@@ -771,6 +1579,8 @@ class WowLauncher(QMainWindow):
 
     def _launch_game(self):
         """实际启动游戏的方法"""
+        import win32con
+        import win32process
         # 获取当前目录
         current_dir = os.path.dirname(os.path.abspath(__file__))
         wow_path = os.path.join(current_dir, 'Wow.exe')
@@ -823,6 +1633,9 @@ class WowLauncher(QMainWindow):
             if self.inject_dll(process_handle, dll_path):
                 # 恢复进程运行
                 win32process.ResumeThread(thread_handle)
+                # 完整校验模式在游戏运行期间后台校验所有文件
+                if self.verify_mode == "deep":
+                    self.start_deep_verify()
             else:
                 # 注入失败则终止进程
                 win32process.TerminateProcess(process_handle.handle, 1)
@@ -848,18 +1661,19 @@ class WowLauncher(QMainWindow):
     async def get_server_info(self):
         """获取服务器信息"""
         try:
-            async with aiohttp.ClientSession() as session:
-                # 使用配的 API URL
-                async with session.get(f"{self.api_base_url}/server_info") as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        # 更新UI
-                        self.update_server_info(data)
-                        return data
-                    else:
-                        raise Exception("获取服务器信息失败")
+            # 使用配的 API URL, 内容未变化时服务器返回304, 使用缓存的信息
+            url = f"{self.api_base_url}/server_info"
+            data = await self.http.fetch_json(url)
+            if data:
+                # 更新UI
+                self.call_in_gui(self.update_server_info, data)
+                cached = self.http.etag_cache.get(url)
+                self.save_server_info_cache(server_info=data, etag=cached[0] if cached else None)
+                return data
+            else:
+                raise Exception("获取服务器信息失败")
         except Exception as e:
-            QMessageBox.warning(self, "错误", f"无法连接到服务器: {str(e)}")
+            self.call_in_gui(QMessageBox.warning, self, "错误", f"无法连接到服务器: {str(e)}")
             return None
 
     def update_server_info(self, server_info):
@@ -881,8 +1695,9 @@ class WowLauncher(QMainWindow):
             self.announcements = server_info.get("announcements", ["暂无公告"])
             for announcement in self.announcements:
                 status += f"{announcement}\n"                
-            # 立即更新显示
+            # 立即更新显示, 无法连接服务器时继续显示这些信息
             self.info_box.setText(status)
+            self.cached_status_text = status
 
             # 更新全局变量
             self.wow_ip = server_info.get("wow_ip", "127.0.0.1")
@@ -894,13 +1709,32 @@ class WowLauncher(QMainWindow):
             self.check_update_before_play = (server_info.get("check_update_before_play", 0))
             self.encryption_key = server_info.get("encryption_key", "@@112233")
             self.max_client_count = server_info.get("max_client_count", 3)
+            self.download_segments = int(server_info.get("download_segments", 1))
+            self.segment_threshold = int(server_info.get("segment_threshold_mb", 64)) * 1024 * 1024
+            verify_mode = server_info.get("verify_mode", "standard")
+            self.verify_mode = verify_mode if verify_mode in VERIFY_MODE_NAMES else "standard"
+            install_profiles = server_info.get("install_profiles", [])
+            if install_profiles != self.install_profiles:
+                self.install_profiles = install_profiles
+                self.update_profile_menu()
+            server_rate_limits = {
+                "download": int(server_info.get("download_limit_kb", 0)),
+                "background": int(server_info.get("background_limit_kb", 1024))
+            }
+            if server_rate_limits != self.server_rate_limits:
+                self.server_rate_limits = server_rate_limits
+                self.apply_rate_limits()
+                self.update_rate_menu()
             print(f"获取到启动前检查更新设置: {self.check_update_before_play}")  # 添加调试日志
             
         except Exception as e:
             print(f"更新服务器信息失败: {str(e)}")
 
     def log_message(self, message):
-        """加日志消息到信息框"""
+        """加日志消息到信息框, 可以在后台线程中调用"""
+        self.log_signal.emit(message)
+
+    def append_log(self, message):
         current_text = self.info_box.toPlainText()
         if current_text:
             current_text += "\n"
@@ -910,19 +1744,6 @@ class WowLauncher(QMainWindow):
         self.info_box.verticalScrollBar().setValue(
             self.info_box.verticalScrollBar().maximum()
         )
-        # 让 Qt 处理事件，立即更新显示
-        QApplication.processEvents()
-
-    def closeEvent(self, event):
-        """窗口关闭时清理资源"""
-        # 关闭事件循环
-        self.loop.close()
-        
-        # 释放互斥锁
-        if hasattr(self, 'mutex'):
-            win32api.CloseHandle(self.mutex)
-            
-        super().closeEvent(event)
 
     async def register_account(self, account, password, security_pwd):
         """发送注册账号请求"""
@@ -1000,6 +1821,7 @@ class WowLauncher(QMainWindow):
 
     def is_wow_running(self):
         """检查WoW进程是否在运行，并返回运行的进程数量"""
+        import psutil
         # 获取当前文件所在目录的绝对路径
         current_dir = os.path.dirname(os.path.abspath(__file__))  
         # 构建当前目录下的 Wow.exe 路径
@@ -1020,13 +1842,16 @@ class WowLauncher(QMainWindow):
 
     def show_window(self):
         """显示主窗口"""
+        self.in_tray = False
         self.show()
         self.setWindowState(Qt.WindowNoState)
         self.activateWindow()
 
     def quit_application(self):
-        """退出应用程序"""
+        """退出应用程序, 资源在closeEvent中清理"""
+        self.quitting = True
         self.tray_icon.hide()
+        self.close()
         QApplication.quit()
 
     def tray_icon_activated(self, reason):
@@ -1034,23 +1859,140 @@ class WowLauncher(QMainWindow):
         if reason == QSystemTrayIcon.DoubleClick:
             self.show_window()
 
-    def closeEvent(self, event):
-        """重写关闭事件，改为最小化到托盘"""
-        event.ignore()
+    def hide_to_tray(self, message):
+        """隐藏窗口到托盘并显示通知, 在托盘中时开始预下载待发布版本"""
         self.hide()
+        self.in_tray = True
         self.tray_icon.showMessage(
             self.windowTitle(),
-            "程序已最小化到系统托盘",
+            message,
             QSystemTrayIcon.Information,
             2000
         )
+        self.start_staging()
+
+    def closeEvent(self, event):
+        """点击关闭按钮时最小化到托盘; 从托盘菜单退出时清理资源"""
+        if not self.quitting:
+            event.ignore()
+            self.hide_to_tray("程序已最小化到系统托盘")
+            return
+
+        # 关闭共用的HTTP会话和事件循环
+        self.stop_loop()
+
+        # 释放互斥锁
+        if hasattr(self, 'mutex'):
+            win32api.CloseHandle(self.mutex)
+
+        super().closeEvent(event)
+
+    def current_install_profile(self):
+        """当前安装方案, 没有选择或服务器已删除该方案时使用服务器的第一个方案"""
+        for profile in self.install_profiles:
+            if profile.get("name") == self.install_profile:
+                return profile
+        return self.install_profiles[0] if self.install_profiles else None
+
+    def selected_content_tags(self):
+        """当前安装方案包含的可选内容标签, 服务器没有安装方案时返回None(同步全部文件)"""
+        profile = self.current_install_profile()
+        if profile is None:
+            return None
+        return set(profile.get("tags", []))
+
+    def update_profile_menu(self):
+        """根据服务器的安装方案重建托盘菜单中的安装方案选项"""
+        self.profile_menu.clear()
+        for action in self.profile_group.actions():
+            self.profile_group.removeAction(action)
+        current = self.current_install_profile()
+        for profile in self.install_profiles:
+            action = self.profile_menu.addAction(profile.get("title", profile["name"]))
+            action.setCheckable(True)
+            action.setChecked(profile is current)
+            self.profile_group.addAction(action)
+            action.triggered.connect(lambda checked, name=profile["name"]: self.select_install_profile(name))
+        self.profile_menu.menuAction().setVisible(bool(self.install_profiles))
+
+    def select_install_profile(self, name):
+        """切换安装方案, 下次检查更新时生效"""
+        self.install_profile = name
+        self.save_launcher_config(install_profile=name)
+        profile = self.current_install_profile()
+        self.log_message(f"安装方案已切换为: {profile.get('title', name)}, 下次检查更新时生效")
+
+    def rate_limit_kb(self, kind):
+        """kind("download"或"background")的限速KB/s, 0为不限速"""
+        value = self.rate_limits.get(kind)
+        return self.server_rate_limits[kind] if value is None else value
+
+    def create_rate_limiters(self):
+        """第一次检查更新或预下载前在界面线程中创建限速器"""
+        if self.download_limiter is not None:
+            return
+        from download_manager import RateLimiter
+        self.download_limiter = RateLimiter()
+        self.staging_limiter = RateLimiter()
+        self.apply_rate_limits()
+
+    def apply_rate_limits(self):
+        """把当前限速设置应用到下载中的连接, 游戏运行时更新下载也不超过后台限速"""
+        if self.download_limiter is None:
+            return
+        download = self.rate_limit_kb("download")
+        background = self.rate_limit_kb("background")
+        if self.game_started_during_update and background:
+            download = min(download, background) if download else background
+        self.download_limiter.rate = download * 1024
+        self.staging_limiter.rate = background * 1024
+
+    @staticmethod
+    def format_rate_limit(kb):
+        if not kb:
+            return "不限速"
+        return f"{kb // 1024} MB/s" if kb % 1024 == 0 else f"{kb} KB/s"
+
+    def update_rate_menu(self):
+        """重建托盘菜单中的限速选项, 第一项跟随服务器的建议值"""
+        for action in self.rate_menu.actions():
+            action.menu().deleteLater()
+        self.rate_menu.clear()
+        for kind, title in RATE_LIMIT_NAMES.items():
+            menu = self.rate_menu.addMenu(title)
+            group = QActionGroup(menu)
+            current = self.rate_limits.get(kind)
+            choices = [None] + RATE_LIMIT_CHOICES
+            for value in choices:
+                if value is None:
+                    text = f"服务器建议({self.format_rate_limit(self.server_rate_limits[kind])})"
+                else:
+                    text = self.format_rate_limit(value)
+                action = menu.addAction(text)
+                action.setCheckable(True)
+                action.setChecked(value == current)
+                group.addAction(action)
+                action.triggered.connect(lambda checked, kind=kind, value=value: self.select_rate_limit(kind, value))
+
+    def select_rate_limit(self, kind, value):
+        """修改限速, 正在进行的下载立即生效; value为None时跟随服务器"""
+        if value is None:
+            self.rate_limits.pop(kind, None)
+        else:
+            self.rate_limits[kind] = value
+        self.save_launcher_config(rate_limits=self.rate_limits)
+        self.apply_rate_limits()
+        self.log_message(f"{RATE_LIMIT_NAMES[kind]}: {self.format_rate_limit(self.rate_limit_kb(kind))}")
 
     def setup_tray_icon(self):
         """初始化系统托盘图标"""
         try:
             # 创建系统托盘图标
             self.tray_icon = QSystemTrayIcon(self)
-            icon = QIcon("wow_icon.png")
+            # 使用程序启动时已加载的图标, 不再重复读取图标文件
+            icon = QApplication.windowIcon()
+            if icon.isNull():
+                icon = QIcon("wow_icon.png")
             self.tray_icon.setIcon(icon)
             self.setWindowIcon(icon)  # 同时设置窗口图标
             
@@ -1058,10 +2000,18 @@ class WowLauncher(QMainWindow):
             tray_menu = QMenu()
             show_action = tray_menu.addAction("显示主窗口")
             show_action.triggered.connect(self.show_window)
+            # 安装方案, 获取到服务器的安装方案后显示
+            self.profile_menu = tray_menu.addMenu("安装方案")
+            self.profile_menu.menuAction().setVisible(False)
+            self.profile_group = QActionGroup(self)
+            # 下载限速
+            self.rate_menu = tray_menu.addMenu("下载限速")
+            self.update_rate_menu()
             quit_action = tray_menu.addAction("退出")
             quit_action.triggered.connect(self.quit_application)
             
-            # 设置托盘图标的菜单
+            # 设置托盘图标的菜单, 保留引用避免菜单被回收
+            self.tray_menu = tray_menu
             self.tray_icon.setContextMenu(tray_menu)
             
             # 托盘图标双击事件
@@ -1315,27 +2265,27 @@ class RegisterDialog(BaseServiceDialog):
             if not self._validate_input(account, password, confirm_pwd, security_pwd, captcha):
                 return
                 
-            # 创建事件循环
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            
-            try:
-                # 获取 WowLauncher 实例并发送注册请求
-                launcher = self.parent()
-                response = loop.run_until_complete(launcher.register_account(account, password, security_pwd))
-                
-                if response.get("success"):
-                    QMessageBox.information(self, "成功", "账号注册成功!")
-                    super().accept()
-                else:
-                    error_msg = response.get("detail", "注册失败")
-                    QMessageBox.warning(self, "错误", error_msg)
-                    
-            finally:
-                loop.close()
+            # 获取 WowLauncher 实例, 在后台发送注册请求, 完成后处理结果
+            launcher = self.parent()
+            self.confirm_btn.setEnabled(False)
+            launcher.run_async(launcher.register_account(account, password, security_pwd), self.on_register_finished)
                 
         except Exception as e:
             QMessageBox.warning(self, "错误", f"注册失败: {str(e)}")
+
+    def on_register_finished(self, future):
+        """注册请求完成后在界面线程中调用"""
+        self.confirm_btn.setEnabled(True)
+        try:
+            response = future.result()
+            if response.get("success"):
+                QMessageBox.information(self, "成功", "账号注册成功!")
+                super().accept()
+            else:
+                error_msg = response.get("detail", "注册失败")
+                QMessageBox.warning(self, "错误", error_msg)
+        except Exception as e:
+            QMessageBox.warning(self, "错误", f"注册失败: {str(e)}")
             
     def _validate_input(self, account, password, confirm_pwd, security_pwd, captcha):
         if not all([account, password, confirm_pwd, security_pwd]):
@@ -1409,27 +2359,27 @@ class ChangePasswordDialog(BaseServiceDialog):
             if not self._validate_input(account, new_password, security_pwd, captcha):
                 return
                 
-            # 创建事件循环
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            
-            try:
-                # 获取 WowLauncher 实例并发送修改密码请求
-                launcher = self.parent()
-                response = loop.run_until_complete(launcher.change_password(account, security_pwd, new_password))
-                
-                if response.get("success"):
-                    QMessageBox.information(self, "成功", "密码修改成功!")
-                    super().accept()
-                else:
-                    error_msg = response.get("detail", "修改密码失败")
-                    QMessageBox.warning(self, "错误", error_msg)
-                    
-            finally:
-                loop.close()
+            # 获取 WowLauncher 实例, 在后台发送修改密码请求, 完成后处理结果
+            launcher = self.parent()
+            self.confirm_btn.setEnabled(False)
+            launcher.run_async(launcher.change_password(account, security_pwd, new_password), self.on_change_password_finished)
                 
         except Exception as e:
             QMessageBox.warning(self, "错误", f"修改密码失败: {str(e)}")
+
+    def on_change_password_finished(self, future):
+        """修改密码请求完成后在界面线程中调用"""
+        self.confirm_btn.setEnabled(True)
+        try:
+            response = future.result()
+            if response.get("success"):
+                QMessageBox.information(self, "成功", "密码修改成功!")
+                super().accept()
+            else:
+                error_msg = response.get("detail", "修改密码失败")
+                QMessageBox.warning(self, "错误", error_msg)
+        except Exception as e:
+            QMessageBox.warning(self, "错误", f"修改密码失败: {str(e)}")
             
     def _validate_input(self, account, new_password, security_pwd, captcha):
         if not all([account, new_password, security_pwd, captcha]):
@@ -1471,7 +2421,15 @@ if __name__ == "__main__":
     # 设置全局字体
     font = QFont("Microsoft YaHei", 12)
     app.setFont(font)
+    STARTUP_REPORT.mark("创建QApplication")
     
     launcher = WowLauncher()
+    STARTUP_REPORT.mark("初始化主窗口")
     launcher.show()
+    STARTUP_REPORT.mark("显示窗口")
+    # 事件循环第一次空闲时窗口已经绘制完成
+    def report_first_paint():
+        STARTUP_REPORT.mark("首次绘制")
+        STARTUP_REPORT.finish()
+    QTimer.singleShot(0, report_first_paint)
     sys.exit(app.exec_())
@@ -30,7 +30,12 @@ DEFAULT_CONFIG = {
     "mysql_user": "root",
     "mysql_password": "root",
     "mysql_database": "realmd",
-    "encryption_key": "@@112233"
+    "encryption_key": "@@112233",
+    "download_segments": 4,
+    "segment_threshold_mb": 64,
+    "verify_mode": "standard",
+    "download_limit_kb": 0,
+    "background_limit_kb": 1024
 }
 
 def save_config(config_data):
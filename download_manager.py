@@ -0,0 +1,618 @@
+# -*- coding: utf-8 -*-
+"""登录器文件下载
+
+文件先下载到预分配完整大小的 .part 临时文件, 完成后再替换正式文件。文件按分段用 Range 请求下载,
+下载日志记录已完成的分段, 登录器崩溃或连接中断后, 下次更新时只下载未完成的分段。
+大文件由多个连接同时请求不同的分段。
+下载时同时计算MD5, 与清单一致才替换正式文件, 失败时按指数退避自动重试。
+接收到的数据交给专用的写入线程, 事件循环只负责网络读取。
+下载速度可以由 RateLimiter 限制, 同一个限速器的所有连接共用限速。
+多个文件通过 DownloadQueue 在同一个会话上并发下载, 本地文件校验的同时就开始下载。
+"""
+import os
+import json
+import errno
+import shutil
+import math
+import time
+import random
+import asyncio
+import hashlib
+import queue
+import bisect
+import threading
+import urllib.parse
+from file_manifest import PRIORITIES, PRIORITY_NORMAL
+
+
+async def gather_or_cancel(tasks):
+    """等待所有任务完成, 任意一个失败时取消其余任务并抛出异常"""
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+class DownloadQueue:
+    """等待下载的文件队列
+
+    检查更新时本地文件校验(生产者)每发现一个需要更新的文件就立即加入队列,
+    下载连接(消费者)同时从队列中取出任务, 校验和下载同时进行。
+    优先级高的文件先下载; 同一优先级的任务按文件大小排序: 大多数连接先下载大文件, 一个连接从小文件开始。
+    """
+    def __init__(self):
+        # 每个优先级一个列表 [(文件大小, 加入顺序, 任务)], 按文件大小升序
+        self.jobs = [[] for _ in PRIORITIES]
+        self.closed = False
+        self.counter = 0
+        # 已加入队列的文件数和总大小, 用于计算进度
+        self.total_count = 0
+        self.total_size = 0
+        self.condition = asyncio.Condition()
+
+    async def put(self, size, job, priority=PRIORITY_NORMAL):
+        async with self.condition:
+            self.counter += 1
+            bisect.insort(self.jobs[PRIORITIES.index(priority)], (size, self.counter, job))
+            self.total_count += 1
+            self.total_size += size
+            self.condition.notify()
+
+    async def close(self):
+        """不再有新任务, 队列取空后下载连接结束"""
+        async with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    async def get(self, small_first=False):
+        """取出一个任务, 队列已关闭且为空时返回None"""
+        async with self.condition:
+            while not any(self.jobs) and not self.closed:
+                await self.condition.wait()
+            for jobs in self.jobs:
+                if jobs:
+                    return jobs.pop(0 if small_first else -1)[2]
+            return None
+
+
+async def run_download_workers(queue, handler, concurrency=4):
+    """启动concurrency个下载连接处理队列中的任务, handler(任务)为协程"""
+    async def worker(small_first):
+        while True:
+            job = await queue.get(small_first)
+            if job is None:
+                return
+            await handler(job)
+
+    await gather_or_cancel([asyncio.create_task(worker(concurrency > 1 and index == concurrency - 1))
+                            for index in range(concurrency)])
+
+
+class DownloadJournal:
+    """下载日志: {服务器路径: {"hash", "size", "local_path", "state", "piece_size", "pieces"}}
+
+    state为downloading表示.part文件可能未下载完, done表示已替换到正式文件。
+    .part文件预分配为完整大小, 按piece_size分段下载, pieces为已完成的分段序号。
+    """
+    def __init__(self, journal_file):
+        self.journal_file = journal_file
+        self.files = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.journal_file, 'r', encoding='utf-8') as f:
+                self.files = json.load(f).get("files", {})
+        except Exception:
+            self.files = {}
+
+    def save(self):
+        try:
+            with open(self.journal_file + ".tmp", 'w', encoding='utf-8') as f:
+                json.dump({"files": self.files}, f, ensure_ascii=False)
+            os.replace(self.journal_file + ".tmp", self.journal_file)
+        except Exception as e:
+            print(f"保存下载日志失败: {str(e)}")
+
+    def get(self, server_path):
+        return self.files.get(server_path)
+
+    def unfinished(self):
+        """返回未完成下载的文件路径列表"""
+        return [path for path, record in self.files.items() if record.get("state") == "downloading"]
+
+    def start(self, server_path, info, local_path, piece_size, pieces=None):
+        self.files[server_path] = {
+            "hash": info["hash"],
+            "size": info["size"],
+            "local_path": local_path,
+            "state": "downloading",
+            "piece_size": piece_size,
+            "pieces": pieces or []
+        }
+        self.save()
+
+    def remove(self, server_path):
+        if self.files.pop(server_path, None) is not None:
+            self.save()
+
+    def finish_piece(self, server_path, index):
+        record = self.files.get(server_path)
+        if record is not None and index not in record.setdefault("pieces", []):
+            record["pieces"].append(index)
+            self.save()
+
+    def finish(self, server_path):
+        if server_path in self.files:
+            self.files[server_path]["state"] = "done"
+            self.save()
+
+    def clear(self):
+        """整个更新完成后删除日志和残留的.part文件"""
+        for record in self.files.values():
+            if record.get("state") == "downloading":
+                try:
+                    os.remove(record["local_path"] + ".part")
+                except OSError:
+                    pass
+        self.files = {}
+        try:
+            os.remove(self.journal_file)
+        except OSError:
+            pass
+
+
+# 检查磁盘空间时额外保留的空间
+DISK_RESERVE = 64 * 1024 * 1024
+
+
+class DownloadError(Exception):
+    """下载失败, retryable为False时(如文件不存在)不再重试"""
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def md5_file_prefix(path, length):
+    """返回文件前length字节的MD5对象, 续传时在此基础上继续计算"""
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        while length > 0:
+            chunk = f.read(min(length, 1024 * 1024))
+            if not chunk:
+                break
+            md5.update(chunk)
+            length -= len(chunk)
+    return md5
+
+
+def preallocate(path, size, keep=False):
+    """把文件扩展到size字节并预先分配磁盘空间, keep为True时保留已有内容"""
+    with open(path, 'r+b' if keep and os.path.exists(path) else 'wb') as f:
+        if size and hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(f.fileno(), 0, size)
+        else:
+            # Windows下扩展文件大小时NTFS会分配实际的磁盘空间
+            f.truncate(size)
+
+
+def check_disk_space(path, needed):
+    """path所在磁盘的可用空间不足needed字节(另保留DISK_RESERVE)时抛出DownloadError"""
+    free = shutil.disk_usage(path).free
+    if free < needed + DISK_RESERVE:
+        raise DownloadError(f"磁盘空间不足: 更新还需要 {needed / 1024 / 1024:.0f} MB, "
+                            f"可用 {free / 1024 / 1024:.0f} MB, 请清理磁盘后重试", retryable=False)
+
+
+class RateLimiter:
+    """令牌桶限速, 共用同一个限速器的所有连接合计不超过rate字节/秒, rate为0时不限速
+
+    读取到数据后扣除令牌, 令牌不足时等待补足后再继续读取, 登录器不读取时TCP流量控制让服务器减慢发送。
+    令牌最多积累一秒的流量, rate可以随时修改, 下次读取时生效。
+    """
+    def __init__(self, rate=0):
+        self.rate = rate
+        self.tokens = 0
+        self.last = time.monotonic()
+
+    def read_size(self, size):
+        """限速时每次最多读取四分之一秒的流量, 让速度更平稳"""
+        if not self.rate:
+            return size
+        return max(4096, min(size, int(self.rate) // 4))
+
+    async def acquire(self, size):
+        rate = self.rate
+        now = time.monotonic()
+        if not rate:
+            self.tokens = 0
+            self.last = now
+            return
+        self.tokens = min(rate, self.tokens + (now - self.last) * rate) - size
+        self.last = now
+        if self.tokens < 0:
+            # 令牌可以透支, 同时等待的连接依次排在已透支的流量之后
+            await asyncio.sleep(-self.tokens / rate)
+
+
+class OrderedHasher:
+    """按文件顺序计算MD5, 各分段的数据可以乱序到达
+
+    还没轮到的数据暂存在内存中, 暂存超过max_pending字节时放弃暂存,
+    由finish从磁盘读取尚未计算的部分。
+    """
+    def __init__(self, max_pending, md5=None, offset=0):
+        self.md5 = md5 or hashlib.md5()
+        self.offset = offset
+        self.pending = {}
+        self.pending_size = 0
+        self.max_pending = max_pending
+        self.overflow = False
+
+    def add(self, position, data):
+        if self.overflow:
+            return
+        if position != self.offset:
+            self.pending[position] = data
+            self.pending_size += len(data)
+            if self.pending_size > self.max_pending:
+                self.overflow = True
+                self.pending.clear()
+            return
+        self.md5.update(data)
+        self.offset += len(data)
+        while self.offset in self.pending:
+            data = self.pending.pop(self.offset)
+            self.pending_size -= len(data)
+            self.md5.update(data)
+            self.offset += len(data)
+
+    def finish(self, path, size):
+        """返回整个文件的MD5, 必要时从磁盘补算offset之后的部分"""
+        if self.offset < size:
+            with open(path, 'rb') as f:
+                f.seek(self.offset)
+                while True:
+                    chunk = f.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    self.md5.update(chunk)
+        return self.md5.hexdigest()
+
+
+class WriteHandle:
+    """写入线程中打开的文件, on_write(位置, 数据)在写入线程中每次写入后调用"""
+    def __init__(self, path, mode, on_write=None):
+        self.file = open(path, mode, buffering=DiskWriter.BUFFER_SIZE)
+        self.on_write = on_write
+        self.error = None
+
+
+class DiskWriter:
+    """专用的磁盘写入线程
+
+    下载连接把收到的数据放进有上限的队列后立即继续接收, 写文件和计算MD5在写入线程中完成,
+    不占用事件循环。磁盘比网络慢时队列写满, 下载连接等待, 内存占用不会无限增长。
+    """
+    QUEUE_SIZE = 64
+    BUFFER_SIZE = 1024 * 1024
+    # 队列中刷新文件缓冲区的标记, 关闭文件的标记位置为None
+    FLUSH = "flush"
+
+    def __init__(self):
+        self.queue = queue.Queue(self.QUEUE_SIZE)
+        self.thread = None
+
+    def open(self, path, mode, on_write=None):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return WriteHandle(path, mode, on_write)
+
+    async def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            # 队列已满, 在线程池中等待, 不阻塞事件循环
+            await asyncio.get_running_loop().run_in_executor(None, self.queue.put, item)
+
+    async def write(self, handle, position, data):
+        """写入数据, position为None时写在文件末尾; 之前的写入出错时抛出异常"""
+        if handle.error:
+            raise handle.error
+        await self.put((handle, position, data))
+
+    async def flush(self, handle):
+        """排队刷新此文件的缓冲区, 不等待写入
+
+        返回的future在之前排队的数据全部写入并刷新后于事件循环中完成, 之后handle.error为None表示都已写入。
+        """
+        done = asyncio.get_running_loop().create_future()
+        await self.put((handle, self.FLUSH, done))
+        return done
+
+    async def close(self, handle):
+        """等待此文件排队的数据全部写入后关闭文件, 写入出错时抛出异常"""
+        done = asyncio.get_running_loop().create_future()
+        await self.put((handle, None, done))
+        await done
+        if handle.error:
+            raise handle.error
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread = None
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            handle, position, data = item
+            if isinstance(data, asyncio.Future):
+                try:
+                    if position == self.FLUSH:
+                        if not handle.error:
+                            handle.file.flush()
+                    else:
+                        handle.file.close()
+                except Exception as e:
+                    handle.error = handle.error or e
+                try:
+                    data.get_loop().call_soon_threadsafe(self.set_done, data)
+                except RuntimeError:
+                    # 事件循环已关闭(登录器正在退出)
+                    pass
+                continue
+            if handle.error:
+                continue
+            try:
+                if position is not None:
+                    handle.file.seek(position)
+                handle.file.write(data)
+                if handle.on_write:
+                    handle.on_write(position, data)
+            except Exception as e:
+                handle.error = e
+
+    @staticmethod
+    def set_done(future):
+        if not future.done():
+            future.set_result(None)
+
+
+class Downloader:
+    """支持断点续传和分段下载的文件下载
+
+    segments为分段下载的连接数, 文件不小于segment_threshold字节时分段下载, 两者由服务器配置。
+    limiter为RateLimiter时按它的速度限制下载。
+    下载的数据先写入.part文件, MD5与清单一致后才替换正式文件。
+    """
+    # 每次从连接读取的字节数, 读满时加倍, 读到的数据很少时减半
+    MIN_CHUNK_SIZE = 64 * 1024
+    MAX_CHUNK_SIZE = 1024 * 1024
+    # 每次请求的最大字节数, 也是断点续传的单位; 连接数较多时分段更小
+    MAX_PIECE_SIZE = 16 * 1024 * 1024
+    PIECE_ALIGN = 1024 * 1024
+    # 失败重试: 第n次重试前等待 0 ~ min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2^n) 秒
+    MAX_RETRIES = 4
+    RETRY_BASE_DELAY = 1
+    RETRY_MAX_DELAY = 30
+    # 按顺序计算MD5时最多暂存的乱序数据
+    MAX_PENDING_HASH = 64 * 1024 * 1024
+
+    def __init__(self, base_url, journal, log=print, segments=1, segment_threshold=64 * 1024 * 1024,
+                 limiter=None):
+        self.base_url = base_url
+        self.journal = journal
+        self.log = log
+        self.segments = max(1, int(segments))
+        self.segment_threshold = segment_threshold
+        self.limiter = limiter
+        self.writer = DiskWriter()
+
+    def close(self):
+        """停止写入线程"""
+        self.writer.stop()
+
+    async def read(self, response, size):
+        """从响应读取最多size字节, 设置了限速器时按限速等待; 差异文件和分块更新也通过这里读取"""
+        if self.limiter:
+            size = self.limiter.read_size(size)
+        chunk = await response.content.read(size)
+        if chunk and self.limiter:
+            await self.limiter.acquire(len(chunk))
+        return chunk
+
+    async def receive(self, response, handle, position, on_progress):
+        """把响应内容交给写入线程写入handle, 返回写入结束的位置"""
+        chunk_size = self.MIN_CHUNK_SIZE
+        while True:
+            chunk = await self.read(response, chunk_size)
+            if not chunk:
+                return position
+            await self.writer.write(handle, position, chunk)
+            if position is not None:
+                position += len(chunk)
+            on_progress(len(chunk))
+            if len(chunk) == chunk_size:
+                chunk_size = min(self.MAX_CHUNK_SIZE, chunk_size * 2)
+            elif len(chunk) < chunk_size // 4:
+                chunk_size = max(self.MIN_CHUNK_SIZE, chunk_size // 2)
+
+    def part_path(self, local_path):
+        return local_path + ".part"
+
+    def piece_size(self, size, connections):
+        """分段大小: 至少每个连接一段, 按1MB对齐"""
+        piece = min(self.MAX_PIECE_SIZE, math.ceil(size / connections))
+        return max(self.PIECE_ALIGN, math.ceil(piece / self.PIECE_ALIGN) * self.PIECE_ALIGN)
+
+    def done_pieces_size(self, record, size):
+        piece_size = record["piece_size"]
+        return sum(min(piece_size, size - index * piece_size) for index in record.get("pieces", []))
+
+    def space_needed(self, local_path, info):
+        """下载这个文件还需要的磁盘空间, .part文件已分配的空间不再需要"""
+        try:
+            stat = os.stat(self.part_path(local_path))
+            allocated = stat.st_blocks * 512 if hasattr(stat, "st_blocks") else stat.st_size
+        except OSError:
+            allocated = 0
+        return max(0, info["size"] - allocated)
+
+    def resume_offset(self, server_path, local_path, info):
+        """返回可以继续下载的字节数, 文件版本已变化或没有.part文件时返回0"""
+        part_path = self.part_path(local_path)
+        record = self.journal.get(server_path)
+        if not os.path.exists(part_path):
+            return 0
+        if (record and record.get("state") == "downloading" and record.get("hash") == info["hash"]
+                and os.path.getsize(part_path) <= info["size"]):
+            if "piece_size" in record:
+                return self.done_pieces_size(record, info["size"])
+            return os.path.getsize(part_path)
+        # 服务器文件已更新, 旧的.part文件不能继续使用
+        try:
+            os.remove(part_path)
+        except OSError:
+            pass
+        return 0
+
+    async def download(self, session, server_path, local_path, info, on_progress=None):
+        """下载文件到local_path, on_progress(字节数)在每次写入后调用
+
+        下载失败或校验不通过时按指数退避重试, 每次等待时间加入随机抖动,
+        避免大量登录器在服务器故障恢复后同时重连。重试前撤回本次报告的进度。
+        """
+        for attempt in range(self.MAX_RETRIES + 1):
+            reported = 0
+
+            def report(size):
+                nonlocal reported
+                reported += size
+                if on_progress:
+                    on_progress(size)
+
+            try:
+                return await self.download_once(session, server_path, local_path, info, report)
+            except Exception as e:
+                if on_progress and reported:
+                    on_progress(-reported)
+                if isinstance(e, DownloadError) and not e.retryable or attempt == self.MAX_RETRIES:
+                    raise
+                if isinstance(e, OSError) and e.errno == errno.ENOSPC:
+                    raise DownloadError(f"磁盘空间不足, 无法写入: {local_path}", retryable=False)
+                delay = random.uniform(0, min(self.RETRY_MAX_DELAY, self.RETRY_BASE_DELAY * 2 ** attempt))
+                self.log(f"下载失败, {delay:.1f} 秒后重试({attempt + 1}/{self.MAX_RETRIES}): {server_path}: {str(e)}")
+                await asyncio.sleep(delay)
+
+    async def download_once(self, session, server_path, local_path, info, on_progress):
+        """下载一次: 预分配.part文件后按分段下载, 按文件顺序计算MD5, 与清单一致才替换正式文件
+
+        不小于segment_threshold的文件由segments个连接同时下载不同的分段, 其余文件用一个连接依次下载。
+        新下载的文件数据到达时就计算MD5, 先到的后面分段暂存在内存中;
+        续传时先读取开头已完成的部分, 暂存数据超过上限时完成后再读取尚未计算的部分。
+        """
+        part_path = self.part_path(local_path)
+        size = info["size"]
+        connections = self.segments if size >= self.segment_threshold else 1
+        offset = self.resume_offset(server_path, local_path, info)
+        record = self.journal.get(server_path)
+        if offset > 0 and "piece_size" not in record:
+            # 旧版本按顺序写入的.part文件, 已写满的分段继续使用
+            piece_size = self.piece_size(size, 1)
+            self.journal.start(server_path, info, local_path, piece_size, list(range(offset // piece_size)))
+            record = self.journal.get(server_path)
+            offset = self.done_pieces_size(record, size)
+
+        loop = asyncio.get_running_loop()
+        if offset > 0:
+            piece_size = record["piece_size"]
+            done = set(record["pieces"])
+            on_progress(offset)
+            self.log(f"继续下载: {server_path}, 已下载 {offset / 1024 / 1024:.1f} MB")
+            await loop.run_in_executor(None, preallocate, part_path, size, True)
+            # 开头连续完成的分段先计算MD5, 后面的数据到达时继续计算
+            prefix = 0
+            while prefix in done:
+                prefix += 1
+            prefix = min(size, prefix * piece_size)
+            md5 = await loop.run_in_executor(None, md5_file_prefix, part_path, prefix)
+            hasher = OrderedHasher(self.MAX_PENDING_HASH, md5, prefix)
+        else:
+            piece_size = self.piece_size(size, connections)
+            done = set()
+            # 预分配完整大小的文件, 避免磁盘碎片, 各分段直接写入对应位置
+            await loop.run_in_executor(None, preallocate, part_path, size)
+            self.journal.start(server_path, info, local_path, piece_size)
+            hasher = OrderedHasher(self.MAX_PENDING_HASH)
+
+        piece_count = math.ceil(size / piece_size)
+        queue = asyncio.Queue()
+        for index in range(piece_count):
+            if index not in done:
+                queue.put_nowait(index)
+        url = f"{self.base_url}/download/{urllib.parse.quote(server_path)}"
+        if connections > 1:
+            self.log(f"分段下载: {server_path}, {queue.qsize()} 段, {connections} 个连接")
+
+        # 各连接的数据都由写入线程按位置写入同一个文件
+        handle = self.writer.open(part_path, 'r+b', hasher.add)
+
+        def piece_written(index):
+            if not handle.error:
+                self.journal.finish_piece(server_path, index)
+
+        async def worker():
+            while not queue.empty():
+                index = queue.get_nowait()
+                start = index * piece_size
+                end = min(size, start + piece_size) - 1
+                headers = {"Range": f"bytes={start}-{end}", "If-Range": f'"{info["hash"]}"'}
+                async with session.get(url, headers=headers) as response:
+                    if (response.status != 206
+                            or not response.headers.get("Content-Range", "").startswith(f"bytes {start}-{end}/")):
+                        if response.status in (200, 206):
+                            # If-Range不匹配时服务器返回整个文件, 说明服务器上的文件已经变化
+                            raise DownloadError(f"服务器上的文件已变化, 请重新检查更新: {server_path}",
+                                                retryable=False)
+                        error_text = await response.text(errors='replace')
+                        raise DownloadError(f"下载失败 ({response.status}): {error_text[:200]}",
+                                            retryable=response.status >= 500)
+                    position = await self.receive(response, handle, start, on_progress)
+                if position != end + 1:
+                    raise Exception(f"下载不完整: {server_path} 第{index}段")
+                # 写入线程写完并刷新这一段后才记为完成, 登录器崩溃时续传不会跳过还在队列中没有写入的分段
+                flushed = await self.writer.flush(handle)
+                flushed.add_done_callback(lambda future, index=index: piece_written(index))
+
+        try:
+            await gather_or_cancel([asyncio.create_task(worker())
+                                    for _ in range(min(connections, queue.qsize()))])
+        finally:
+            await self.writer.close(handle)
+
+        md5 = await loop.run_in_executor(None, hasher.finish, part_path, size)
+        self.verify_part(server_path, local_path, info, md5)
+        try:
+            os.replace(part_path, local_path)
+        except PermissionError:
+            # 游戏运行时正在使用的文件无法替换, 已下载完整的.part文件保留, 下次更新时直接替换
+            raise DownloadError(f"文件正在使用, 下次更新时替换: {server_path}", retryable=False)
+        self.journal.finish(server_path)
+
+    def verify_part(self, server_path, local_path, info, md5):
+        """校验.part文件的MD5, 不一致时删除.part文件和下载记录, 下次重试重新下载"""
+        if md5 == info["hash"]:
+            return
+        try:
+            os.remove(self.part_path(local_path))
+        except OSError:
+            pass
+        self.journal.remove(server_path)
+        raise DownloadError(f"文件校验失败: {server_path}")
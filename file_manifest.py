@@ -0,0 +1,912 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import struct
+import select
+import ctypes
+import ctypes.util
+import uuid
+import zlib
+import hashlib
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# 分块读取大小, 哈希时内存占用固定为一个块
+HASH_CHUNK_SIZE = 1024 * 1024
+# 待计算的数据量超过该值时才启用进程池, 小量文件直接在当前线程计算
+PARALLEL_HASH_THRESHOLD = 64 * 1024 * 1024
+# 分块校验的块大小, 登录器按块比较后只下载不同的块
+BLOCK_SIZE = 1024 * 1024
+# 每个文件保留的历史版本数, 服务器为这些版本生成到当前版本的差异文件
+DELTA_HISTORY = 3
+# 差异文件超过新文件大小的该比例时不生成, 直接完整下载更合适
+DELTA_MAX_RATIO = 0.8
+DELTA_MAGIC = b"WOWDELTA1\n"
+DELTA_COPY = struct.Struct("<II")
+DELTA_DATA = struct.Struct("<I")
+# 变更记录最多保留的条数, 超出后最早的记录被丢弃, 更早版本的客户端需要完整清单
+CHANGE_LOG_LIMIT = 10000
+# 文件更新优先级, 按更新顺序排列: 关键文件更新完成后即可启动游戏, 可选文件(如语音包)最后更新;
+# 清单中没有priority字段的文件为normal
+PRIORITY_CRITICAL = "critical"
+PRIORITY_NORMAL = "normal"
+PRIORITY_OPTIONAL = "optional"
+PRIORITIES = (PRIORITY_CRITICAL, PRIORITY_NORMAL, PRIORITY_OPTIONAL)
+
+
+def hash_file(full_path, chunk_size=HASH_CHUNK_SIZE):
+    """分块计算文件MD5, 重复使用同一块缓冲区, 内存占用与文件大小无关"""
+    md5_hash = hashlib.md5()
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(full_path, 'rb', buffering=0) as f:
+        while True:
+            read_size = f.readinto(buffer)
+            if not read_size:
+                break
+            md5_hash.update(view[:read_size])
+    return md5_hash.hexdigest()
+
+
+def hash_file_blocks(full_path, block_size=BLOCK_SIZE):
+    """一次读取同时计算整个文件的MD5和每个块的CRC32, 返回 (MD5, [块CRC32])
+
+    块校验只用于定位不同的块, 文件是否正确仍以整个文件的MD5为准,
+    因此块使用开销很小的CRC32, 不需要再做一遍MD5。
+    """
+    md5_hash = hashlib.md5()
+    blocks = []
+    block_crc = 0
+    block_filled = 0
+    buffer = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(full_path, 'rb', buffering=0) as f:
+        while True:
+            read_size = f.readinto(buffer)
+            if not read_size:
+                break
+            md5_hash.update(view[:read_size])
+            offset = 0
+            while offset < read_size:
+                take = min(block_size - block_filled, read_size - offset)
+                block_crc = zlib.crc32(view[offset:offset + take], block_crc)
+                block_filled += take
+                offset += take
+                if block_filled == block_size:
+                    blocks.append(f"{block_crc:08x}")
+                    block_crc = 0
+                    block_filled = 0
+    if block_filled:
+        blocks.append(f"{block_crc:08x}")
+    return md5_hash.hexdigest(), blocks
+
+
+def create_delta(old_blocks, old_size, new_path, new_blocks, new_size, delta_path, block_size=BLOCK_SIZE):
+    """根据旧版本的分块校验和新文件生成差异文件, 返回差异文件大小, 不值得生成时返回None
+
+    只需要旧版本的块校验而不需要旧文件本身: 新文件中与旧版本某个块(任意位置)相同的块
+    记为复制操作, 其余块作为数据写入差异文件。块按整块对齐比较, 适合MPQ这类在原位置
+    修改或在末尾追加内容的文件。格式:
+      DELTA_MAGIC + JSON头一行 + 若干操作
+      b'C' + (旧文件起始块, 块数)   从旧文件复制连续的块
+      b'D' + (长度) + 数据           直接写入的数据
+    """
+    full_old_blocks = old_size // block_size
+    old_index = {}
+    for index, crc in enumerate(old_blocks[:full_old_blocks]):
+        old_index.setdefault(crc, index)
+    old_tail = (old_blocks[-1], old_size % block_size) if old_size % block_size and old_blocks else None
+
+    # 合并相邻的操作: ['C', 旧起始块, 块数] 或 ['D', 新起始块, 块数]
+    ops = []
+    data_size = 0
+    for index, crc in enumerate(new_blocks):
+        length = min(block_size, new_size - index * block_size)
+        if length == block_size and crc in old_index:
+            source = old_index[crc]
+        elif length < block_size and old_tail == (crc, length):
+            source = full_old_blocks
+        else:
+            source = None
+
+        if source is not None:
+            if ops and ops[-1][0] == 'C' and ops[-1][1] + ops[-1][2] == source:
+                ops[-1][2] += 1
+            else:
+                ops.append(['C', source, 1])
+        else:
+            data_size += length
+            if ops and ops[-1][0] == 'D':
+                ops[-1][2] += 1
+            else:
+                ops.append(['D', index, 1])
+
+    if data_size > new_size * DELTA_MAX_RATIO:
+        return None
+
+    temp_path = delta_path + ".tmp"
+    with open(new_path, 'rb') as new_file, open(temp_path, 'wb') as out:
+        out.write(DELTA_MAGIC)
+        out.write(json.dumps({"block_size": block_size, "size": new_size}).encode("utf-8") + b"\n")
+        for op, start, count in ops:
+            if op == 'C':
+                out.write(b'C' + DELTA_COPY.pack(start, count))
+                continue
+            offset = start * block_size
+            length = min(count * block_size, new_size - offset)
+            out.write(b'D' + DELTA_DATA.pack(length))
+            new_file.seek(offset)
+            while length > 0:
+                chunk = new_file.read(min(HASH_CHUNK_SIZE, length))
+                if not chunk:
+                    raise IOError(f"文件在生成差异时被修改: {new_path}")
+                out.write(chunk)
+                length -= len(chunk)
+    os.replace(temp_path, delta_path)
+    return os.path.getsize(delta_path)
+
+
+def apply_delta(delta_path, old_path, new_path):
+    """用本地旧文件和差异文件生成新文件, 返回新文件的MD5供调用方校验
+
+    新文件最多写入差异文件头中记录的大小, MD5只计算实际写入的内容, 与新文件完全对应。
+    """
+    md5_hash = hashlib.md5()
+    remaining = 0
+
+    def copy_bytes(source, out, length):
+        nonlocal remaining
+        # 超出新文件大小的部分不写入, 但要跳过, 保持差异文件的读取位置正确
+        skip = max(0, length - remaining)
+        length -= skip
+        while length > 0:
+            chunk = source.read(min(HASH_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            out.write(chunk)
+            md5_hash.update(chunk)
+            length -= len(chunk)
+            remaining -= len(chunk)
+        if skip:
+            source.seek(skip, os.SEEK_CUR)
+
+    with open(delta_path, 'rb') as delta, open(old_path, 'rb') as old, open(new_path, 'wb') as out:
+        if delta.readline() != DELTA_MAGIC:
+            raise ValueError("差异文件格式错误")
+        header = json.loads(delta.readline())
+        block_size = header["block_size"]
+        remaining = header["size"]
+        while True:
+            op = delta.read(1)
+            if not op:
+                break
+            if op == b'C':
+                start, count = DELTA_COPY.unpack(delta.read(DELTA_COPY.size))
+                old.seek(start * block_size)
+                copy_bytes(old, out, count * block_size)
+            elif op == b'D':
+                (length,) = DELTA_DATA.unpack(delta.read(DELTA_DATA.size))
+                copy_bytes(delta, out, length)
+            else:
+                raise ValueError("差异文件格式错误")
+        if remaining:
+            raise ValueError("差异文件生成的文件不完整")
+    return md5_hash.hexdigest()
+
+
+def build_tree(files):
+    """根据 {相对路径: {"hash", "size", ...}} 构建哈希树, 返回 {目录路径: 节点}
+
+    根目录的路径为""。每个节点为 {"hash", "dirs": {子目录名: 哈希}, "files": {文件名: {"hash", "size", "deltas", "priority", "tags"}}},
+    目录哈希由按名称排序的子目录哈希和文件哈希计算得出, 服务器和登录器使用同一算法,
+    根哈希相同即说明全部文件相同。
+    """
+    nodes = {"": {"dirs": {}, "files": {}}}
+    for relative_path, info in files.items():
+        parts = relative_path.split('/')
+        dir_path = ""
+        for part in parts[:-1]:
+            child_path = f"{dir_path}/{part}" if dir_path else part
+            if child_path not in nodes:
+                nodes[child_path] = {"dirs": {}, "files": {}}
+                nodes[dir_path]["dirs"][part] = None
+            dir_path = child_path
+        node_info = {"hash": info["hash"], "size": info["size"]}
+        if info.get("deltas"):
+            node_info["deltas"] = info["deltas"]
+        if info.get("priority"):
+            node_info["priority"] = info["priority"]
+        if info.get("tags"):
+            node_info["tags"] = info["tags"]
+        nodes[dir_path]["files"][parts[-1]] = node_info
+
+    # 从最深的目录开始计算, 保证计算父目录时子目录哈希已经就绪
+    def depth(dir_path):
+        return dir_path.count('/') + 1 if dir_path else 0
+
+    for dir_path in sorted(nodes, key=depth, reverse=True):
+        node = nodes[dir_path]
+        lines = []
+        for name in sorted(node["dirs"]):
+            child_path = f"{dir_path}/{name}" if dir_path else name
+            node["dirs"][name] = nodes[child_path]["hash"]
+            lines.append(f"d {name} {node['dirs'][name]}")
+        for name in sorted(node["files"]):
+            info = node["files"][name]
+            line = f"f {name} {info['hash']} {info['size']}"
+            # 优先级和可选内容标签变化也要改变目录哈希, 登录器才会同步到新的设置
+            if info.get("priority"):
+                line += f" {info['priority']}"
+            if info.get("tags"):
+                line += f" tags={','.join(info['tags'])}"
+            lines.append(line)
+        node["hash"] = hashlib.md5("\n".join(lines).encode("utf-8")).hexdigest()
+    return nodes
+
+
+class FileManifest:
+    """Download目录文件清单
+
+    以 (相对路径, 大小, mtime_ns, inode) 作为缓存键, 哈希结果持久化到Download旁边的
+    缓存文件中, 只有键发生变化的文件才会重新计算哈希。
+    """
+
+    CACHE_VERSION = 2
+
+    def __init__(self, download_path, cache_file, delta_dir=None):
+        self.download_path = download_path
+        self.cache_file = cache_file
+        # 差异文件目录, 为None时不生成差异文件
+        self.delta_dir = delta_dir
+        self.entries = {}
+        # 清单版本号, 每次内容变化加一; manifest_id在缓存重建时重新生成,
+        # 两者组合可以唯一标识一个版本的清单(服务器重启后仍然有效)
+        self.generation = 0
+        self.manifest_id = uuid.uuid4().hex
+        # 变更记录 [(版本号, 相对路径)], 只在内存中保存;
+        # change_log_start 之后的每个版本的变化都能在记录中找到
+        self.change_log = []
+        self.change_log_start = 0
+        self.ready = False
+        self.lock = threading.Lock()
+        # 日志输出函数, 服务器界面启动后会替换为写入服务器日志
+        self.log = print
+        self.load_cache()
+        self.change_log_start = self.generation
+
+    def load_cache(self):
+        """从缓存文件加载哈希清单"""
+        try:
+            if os.path.exists(self.cache_file):
+                with open(self.cache_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get("version") == self.CACHE_VERSION:
+                    self.entries = data.get("files", {})
+                    self.generation = data.get("generation", 0)
+                    self.manifest_id = data.get("manifest_id") or self.manifest_id
+                    print(f"已加载文件清单缓存: {len(self.entries)}个文件")
+        except Exception as e:
+            print(f"加载文件清单缓存失败: {e}")
+            self.entries = {}
+
+    def save_cache(self):
+        """保存哈希清单到缓存文件(先写临时文件再替换, 避免写到一半的缓存)"""
+        try:
+            temp_file = self.cache_file + ".tmp"
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump({
+                    "version": self.CACHE_VERSION,
+                    "manifest_id": self.manifest_id,
+                    "generation": self.generation,
+                    "files": self.entries
+                }, f, ensure_ascii=False)
+            os.replace(temp_file, self.cache_file)
+        except Exception as e:
+            print(f"保存文件清单缓存失败: {e}")
+
+    @staticmethod
+    def stat_key(st):
+        """文件的缓存键: 大小, 修改时间(纳秒), inode"""
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def hash_files(self, pending):
+        """计算一批文件的哈希, pending为 [(相对路径, 完整路径, 大小)], 返回 {相对路径: (MD5, 块校验列表)}
+
+        数据量较大时把文件分配到进程池中并行计算, 按文件大小从大到小提交以均衡负载,
+        并定期输出进度和速度。
+        """
+        results = {}
+        if not pending:
+            return results
+
+        total_files = len(pending)
+        total_bytes = sum(size for _, _, size in pending)
+        done_files = 0
+        done_bytes = 0
+        start_time = time.monotonic()
+        last_report = start_time
+
+        def report(force=False):
+            nonlocal last_report
+            now = time.monotonic()
+            if not force and now - last_report < 1:
+                return
+            last_report = now
+            elapsed = max(now - start_time, 0.001)
+            self.log(
+                f"文件哈希进度: {done_files}/{total_files} 个文件, "
+                f"{done_files / elapsed:.1f} 文件/秒, "
+                f"{done_bytes / elapsed / 1024 / 1024:.1f} MB/秒"
+            )
+
+        self.log(f"开始计算文件哈希: {total_files} 个文件, 共 {total_bytes / 1024 / 1024:.1f} MB")
+        pending = sorted(pending, key=lambda item: item[2], reverse=True)
+
+        if total_files > 1 and total_bytes >= PARALLEL_HASH_THRESHOLD:
+            workers = min(os.cpu_count() or 1, total_files)
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {
+                    pool.submit(hash_file_blocks, full_path): (relative_path, size)
+                    for relative_path, full_path, size in pending
+                }
+                for future in as_completed(futures):
+                    relative_path, size = futures[future]
+                    try:
+                        results[relative_path] = future.result()
+                    except Exception as e:
+                        self.log(f"计算文件哈希失败 {relative_path}: {e}")
+                    done_files += 1
+                    done_bytes += size
+                    report()
+        else:
+            for relative_path, full_path, size in pending:
+                try:
+                    results[relative_path] = hash_file_blocks(full_path)
+                except Exception as e:
+                    self.log(f"计算文件哈希失败 {relative_path}: {e}")
+                done_files += 1
+                done_bytes += size
+                report()
+
+        report(force=True)
+        return results
+
+    def stat_files(self):
+        """遍历Download目录, 返回 {相对路径: (完整路径, 缓存键)}, 只做stat不读文件"""
+        result = {}
+        for root, _, files in os.walk(self.download_path):
+            for file in files:
+                full_path = os.path.join(root, file)
+                relative_path = os.path.relpath(full_path, self.download_path)
+                relative_path = relative_path.replace('\\', '/')
+
+                try:
+                    st = os.stat(full_path)
+                except OSError as e:
+                    self.log(f"读取文件信息失败 {relative_path}: {e}")
+                    continue
+
+                result[relative_path] = (full_path, self.stat_key(st))
+        return result
+
+    def scan(self):
+        """扫描Download目录, 返回 {相对路径: 条目}
+
+        未变化的文件只需要一次stat(), 只有新增或变化的文件才会重新读取计算哈希。
+        """
+        with self.lock:
+            new_entries = {}
+            pending = []
+            keys = {}
+
+            for relative_path, (full_path, key) in self.stat_files().items():
+                cached = self.entries.get(relative_path)
+                if cached and cached.get("key") == key:
+                    new_entries[relative_path] = cached
+                    continue
+
+                keys[relative_path] = key
+                pending.append((relative_path, full_path, key[0]))
+
+            for relative_path, (file_hash, blocks) in self.hash_files(pending).items():
+                new_entries[relative_path] = self.build_entry(
+                    relative_path, keys[relative_path], file_hash, blocks, self.entries.get(relative_path))
+
+            changed_paths = [relative_path for relative_path, _, _ in pending]
+            changed_paths.extend(path for path in self.entries if path not in new_entries)
+            if changed_paths:
+                self.entries = new_entries
+                self.commit_changes(changed_paths)
+                self.clean_deltas()
+
+            self.ready = True
+            return dict(self.entries)
+
+    def refresh_paths(self, relative_paths):
+        """只更新指定的文件: 重新计算新增或修改的文件, 删除已不存在的文件
+
+        哈希计算在锁外进行, 计算期间清单仍可正常读取。返回计算失败需要稍后重试的路径。
+        """
+        pending = []
+        keys = {}
+        removed = []
+        with self.lock:
+            cached_entries = {relative_path: self.entries.get(relative_path) for relative_path in relative_paths}
+
+        for relative_path in relative_paths:
+            full_path = os.path.join(self.download_path, relative_path)
+            try:
+                st = os.stat(full_path)
+            except FileNotFoundError:
+                removed.append(relative_path)
+                continue
+            except OSError as e:
+                self.log(f"读取文件信息失败 {relative_path}: {e}")
+                continue
+
+            key = self.stat_key(st)
+            cached = cached_entries[relative_path]
+            if cached and cached.get("key") == key:
+                continue
+            keys[relative_path] = key
+            pending.append((relative_path, full_path, st.st_size))
+
+        hashes = self.hash_files(pending)
+        failed = {relative_path for relative_path, _, _ in pending if relative_path not in hashes}
+
+        # 差异文件在锁外生成, 和新的哈希一起提交, 保证清单中出现的差异文件都已就绪
+        new_entries = {}
+        for relative_path, (file_hash, blocks) in hashes.items():
+            new_entries[relative_path] = self.build_entry(
+                relative_path, keys[relative_path], file_hash, blocks, cached_entries[relative_path])
+
+        with self.lock:
+            changed_paths = []
+            for relative_path in removed:
+                if self.entries.pop(relative_path, None) is not None:
+                    self.log(f"文件已删除: {relative_path}")
+                    changed_paths.append(relative_path)
+            for relative_path, entry in new_entries.items():
+                self.log(f"文件已更新: {relative_path}")
+                self.entries[relative_path] = entry
+                changed_paths.append(relative_path)
+            if changed_paths:
+                self.commit_changes(changed_paths)
+                self.clean_deltas()
+
+        return failed
+
+    def build_entry(self, relative_path, key, file_hash, blocks, old_entry):
+        """生成文件的清单条目, 内容变化时把旧版本加入历史并生成差异文件"""
+        entry = {
+            "key": key,
+            "hash": file_hash,
+            "size": key[0],
+            "blocks": blocks
+        }
+        if not old_entry or not self.delta_dir:
+            return entry
+        if old_entry["hash"] == file_hash:
+            # 只是修改时间变化, 内容相同, 沿用原来的历史和差异文件
+            for field in ("history", "deltas"):
+                if field in old_entry:
+                    entry[field] = old_entry[field]
+            return entry
+
+        history = [{
+            "hash": old_entry["hash"],
+            "size": old_entry["size"],
+            "blocks": old_entry.get("blocks", [])
+        }] + old_entry.get("history", [])
+        entry["history"] = [item for item in history if item["hash"] != file_hash][:DELTA_HISTORY]
+
+        if entry["size"] < 2 * BLOCK_SIZE:
+            return entry
+
+        os.makedirs(self.delta_dir, exist_ok=True)
+        full_path = os.path.join(self.download_path, relative_path)
+        deltas = {}
+        for item in entry["history"]:
+            if not item["blocks"]:
+                continue
+            try:
+                delta_size = create_delta(
+                    item["blocks"], item["size"], full_path, blocks, entry["size"],
+                    self.delta_path(item["hash"], file_hash))
+            except Exception as e:
+                self.log(f"生成差异文件失败 {relative_path}: {e}")
+                continue
+            if delta_size is not None:
+                deltas[item["hash"]] = delta_size
+                self.log(f"已生成差异文件: {relative_path} ({item['hash'][:8]} -> {file_hash[:8]}, {delta_size / 1024 / 1024:.1f} MB)")
+        if deltas:
+            entry["deltas"] = deltas
+        return entry
+
+    def delta_path(self, from_hash, to_hash):
+        """差异文件路径, 以新旧版本的哈希命名"""
+        return os.path.join(self.delta_dir, f"{from_hash}_{to_hash}.delta")
+
+    def clean_deltas(self):
+        """删除清单中已不再引用的差异文件(调用方需持有锁)"""
+        if not self.delta_dir or not os.path.isdir(self.delta_dir):
+            return
+        in_use = {
+            os.path.basename(self.delta_path(from_hash, entry["hash"]))
+            for entry in self.entries.values()
+            for from_hash in entry.get("deltas", {})
+        }
+        for name in os.listdir(self.delta_dir):
+            if name not in in_use:
+                try:
+                    os.remove(os.path.join(self.delta_dir, name))
+                except OSError as e:
+                    self.log(f"删除过期差异文件失败 {name}: {e}")
+
+    def commit_changes(self, changed_paths):
+        """记录一批变化并生成新的清单版本(调用方需持有锁)"""
+        self.generation += 1
+        self.change_log.extend((self.generation, path) for path in changed_paths)
+        if len(self.change_log) > CHANGE_LOG_LIMIT:
+            dropped = self.change_log[:len(self.change_log) - CHANGE_LOG_LIMIT]
+            self.change_log = self.change_log[len(dropped):]
+            self.change_log_start = dropped[-1][0]
+        self.save_cache()
+
+    def changes_since(self, generation):
+        """返回 (当前版本号, 版本generation之后变化过的路径集合), 变更记录已无法覆盖该版本时返回None"""
+        with self.lock:
+            if generation < self.change_log_start or generation > self.generation:
+                return None
+            return self.generation, {path for gen, path in self.change_log if gen > generation}
+
+    def version_tag(self):
+        """当前清单版本的唯一标识, 尚未扫描过时先扫描一次"""
+        if not self.ready:
+            self.scan()
+        return f"{self.manifest_id}-{self.generation}"
+
+    def get_entry(self, relative_path):
+        """获取单个文件的清单条目, 不存在时返回None"""
+        with self.lock:
+            return self.entries.get(relative_path)
+
+    def versioned_snapshot(self):
+        """返回 (清单版本号, 文件清单), 两者取自同一时刻, 尚未扫描过时先扫描一次"""
+        if not self.ready:
+            self.scan()
+        with self.lock:
+            return self.generation, dict(self.entries)
+
+    def snapshot(self):
+        """返回当前内存中的文件清单, 尚未扫描过时先扫描一次"""
+        if not self.ready:
+            return self.scan()
+        with self.lock:
+            return dict(self.entries)
+
+
+class LocalFileIndex:
+    """登录器本地文件索引: 相对路径 -> {"key": [大小, mtime_ns, inode], "hash", "blocks"}
+
+    和服务器的文件清单缓存一样以文件状态作为键, 只有状态变化的文件才需要重新计算哈希。
+    blocks为None表示只知道文件MD5(例如刚下载完成的文件), 需要分块校验时再计算。
+    repair为后台完整校验发现损坏、等待下次更新修复的文件, 和文件状态无关。
+    """
+
+    INDEX_VERSION = 1
+
+    def __init__(self, client_root, index_file):
+        self.client_root = client_root
+        self.index_file = index_file
+        self.entries = {}
+        self.repair = set()
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            if os.path.exists(self.index_file):
+                with open(self.index_file, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get("version") == self.INDEX_VERSION:
+                    self.entries = data.get("files", {})
+                    self.repair = set(data.get("repair", []))
+        except Exception as e:
+            print(f"加载本地文件索引失败: {e}")
+            self.entries = {}
+            self.repair = set()
+
+    def save(self):
+        """索引有变化时保存(先写临时文件再替换)"""
+        if not self.dirty:
+            return
+        try:
+            temp_file = self.index_file + ".tmp"
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump({
+                    "version": self.INDEX_VERSION,
+                    "files": self.entries,
+                    "repair": sorted(self.repair)
+                }, f, ensure_ascii=False)
+            os.replace(temp_file, self.index_file)
+            self.dirty = False
+        except Exception as e:
+            print(f"保存本地文件索引失败: {e}")
+
+    def relative_path(self, full_path):
+        return os.path.relpath(str(full_path), self.client_root).replace('\\', '/')
+
+    def stat_key(self, full_path):
+        """返回文件当前的状态键, 文件不存在时返回None"""
+        try:
+            return FileManifest.stat_key(os.stat(full_path))
+        except OSError:
+            return None
+
+    def lookup(self, full_path):
+        """文件状态和索引一致时返回 (MD5, 块校验列表或None), 否则返回None"""
+        relative_path = self.relative_path(full_path)
+        entry = self.entries.get(relative_path)
+        if entry is None:
+            return None
+        if entry["key"] != self.stat_key(full_path):
+            del self.entries[relative_path]
+            self.dirty = True
+            return None
+        return entry["hash"], entry.get("blocks")
+
+    def update(self, full_path, key, md5, blocks=None):
+        """记录文件哈希, key为计算哈希前取得的状态键, 计算期间文件被修改时下次会重新计算"""
+        if key is None:
+            return
+        relative_path = self.relative_path(full_path)
+        self.entries[relative_path] = {"key": key, "hash": md5, "blocks": blocks}
+        self.repair.discard(relative_path)
+        self.dirty = True
+
+    def mark_repair(self, full_path):
+        self.repair.add(self.relative_path(full_path))
+        self.dirty = True
+
+    def needs_repair(self, full_path):
+        return self.relative_path(full_path) in self.repair
+
+
+class Inotify:
+    """Linux inotify的ctypes封装, 不依赖第三方库"""
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                  IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1失败")
+
+    def add_watch(self, path):
+        """添加目录监视, 返回watch描述符"""
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch失败: {path}")
+        return wd
+
+    def rm_watch(self, wd):
+        """移除目录监视, 目录已被删除(监视已自动移除)时忽略错误"""
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout):
+        """等待并读取事件, 返回 [(wd, mask, name)]"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_len = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = data[offset:offset + name_len].rstrip(b"\0")
+            offset += name_len
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ManifestWatcher(threading.Thread):
+    """后台监视Download目录并增量维护文件清单
+
+    Linux下使用inotify, 其他系统(或inotify不可用时)定期对比stat结果。
+    发生变化的文件在大小和修改时间稳定 debounce 秒后才重新计算哈希,
+    避免对正在复制中的文件计算出错误的哈希。
+    """
+
+    def __init__(self, manifest, debounce=3.0, poll_interval=5.0):
+        super().__init__(daemon=True)
+        self.manifest = manifest
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.stop_event = threading.Event()
+        # 待处理的文件: 相对路径 -> (最后一次变化的时间, 最后一次看到的缓存键)
+        self.dirty = {}
+        self.watch_dirs = {}
+
+    def stop(self):
+        self.stop_event.set()
+
+    def mark_dirty(self, relative_path):
+        self.dirty[relative_path] = (time.monotonic(), self.current_key(relative_path))
+
+    def current_key(self, relative_path):
+        try:
+            st = os.stat(os.path.join(self.manifest.download_path, relative_path))
+        except OSError:
+            return None
+        return FileManifest.stat_key(st)
+
+    def mark_changed_files(self):
+        """对比stat结果和清单, 把新增、修改、删除的文件标记为待处理"""
+        current = self.manifest.stat_files()
+        with self.manifest.lock:
+            entries = self.manifest.entries
+            for relative_path, (_, key) in current.items():
+                cached = entries.get(relative_path)
+                if (not cached or cached.get("key") != key) and relative_path not in self.dirty:
+                    self.mark_dirty(relative_path)
+            for relative_path in entries:
+                if relative_path not in current and relative_path not in self.dirty:
+                    self.mark_dirty(relative_path)
+
+    def process_dirty(self):
+        """处理已稳定的待处理文件"""
+        now = time.monotonic()
+        ready = []
+        for relative_path, (changed_at, last_key) in list(self.dirty.items()):
+            key = self.current_key(relative_path)
+            if key != last_key:
+                # 文件仍在写入, 重新计时
+                self.dirty[relative_path] = (now, key)
+            elif now - changed_at >= self.debounce:
+                ready.append(relative_path)
+
+        if not ready:
+            return
+        for relative_path in ready:
+            del self.dirty[relative_path]
+        for relative_path in self.manifest.refresh_paths(ready):
+            self.mark_dirty(relative_path)
+
+    def add_watch_tree(self, inotify, directory):
+        """递归监视目录, 返回新发现的文件"""
+        found = []
+        for root, dirs, files in os.walk(directory):
+            try:
+                wd = inotify.add_watch(root)
+            except OSError as e:
+                self.manifest.log(f"监视目录失败 {root}: {e}")
+                continue
+            relative_dir = os.path.relpath(root, self.manifest.download_path).replace('\\', '/')
+            self.watch_dirs[wd] = "" if relative_dir == "." else relative_dir + "/"
+            found.extend(self.watch_dirs[wd] + file for file in files)
+        return found
+
+    def remove_watch_tree(self, inotify, relative_dir):
+        """目录被移走后移除它和子目录的监视
+
+        移走的目录仍被监视, 不移除时它里面的事件会按旧路径报告; 移到Download目录中的其他位置时由IN_MOVED_TO重新监视。
+        """
+        prefix = relative_dir + "/"
+        for wd, watch_prefix in list(self.watch_dirs.items()):
+            if watch_prefix.startswith(prefix):
+                del self.watch_dirs[wd]
+                inotify.rm_watch(wd)
+
+    def run(self):
+        inotify = None
+        if sys.platform.startswith("linux"):
+            try:
+                inotify = Inotify()
+            except (OSError, AttributeError) as e:
+                self.manifest.log(f"inotify不可用, 改为定期扫描: {e}")
+
+        if inotify:
+            self.manifest.log("文件监视已启动(inotify)")
+            try:
+                self.run_inotify(inotify)
+            finally:
+                inotify.close()
+        else:
+            self.manifest.log(f"文件监视已启动(每{self.poll_interval:g}秒扫描)")
+            self.run_polling()
+
+    def run_polling(self):
+        while not self.stop_event.is_set():
+            try:
+                self.mark_changed_files()
+                self.process_dirty()
+            except Exception as e:
+                self.manifest.log(f"文件监视出错: {e}")
+            self.stop_event.wait(self.poll_interval)
+
+    def run_inotify(self, inotify):
+        os.makedirs(self.manifest.download_path, exist_ok=True)
+        self.add_watch_tree(inotify, self.manifest.download_path)
+        # 监视建立之前发生的变化
+        self.mark_changed_files()
+
+        while not self.stop_event.is_set():
+            try:
+                timeout = self.debounce / 2 if self.dirty else 1.0
+                for wd, mask, name in inotify.read_events(timeout):
+                    if mask & Inotify.IN_Q_OVERFLOW:
+                        # 事件队列溢出, 回退为一次完整的stat对比
+                        self.mark_changed_files()
+                        continue
+                    if mask & Inotify.IN_IGNORED:
+                        self.watch_dirs.pop(wd, None)
+                        continue
+
+                    prefix = self.watch_dirs.get(wd)
+                    if prefix is None or not name:
+                        continue
+                    relative_path = prefix + name
+
+                    if mask & Inotify.IN_ISDIR:
+                        if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                            full_dir = os.path.join(self.manifest.download_path, relative_path)
+                            for found in self.add_watch_tree(inotify, full_dir):
+                                self.mark_dirty(found)
+                        elif mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+                            if mask & Inotify.IN_MOVED_FROM:
+                                self.remove_watch_tree(inotify, relative_path)
+                            with self.manifest.lock:
+                                gone = [path for path in self.manifest.entries
+                                        if path.startswith(relative_path + "/")]
+                            for path in gone:
+                                self.mark_dirty(path)
+                        continue
+
+                    self.mark_dirty(relative_path)
+
+                self.process_dirty()
+            except Exception as e:
+                self.manifest.log(f"文件监视出错: {e}")
+                self.stop_event.wait(1.0)
+
+
+if __name__ == "__main__":
+    # 冷启动构建测试: python file_manifest.py [Download目录]
+    import tempfile
+
+    target = sys.argv[1] if len(sys.argv) > 1 else "Download"
+    with tempfile.TemporaryDirectory() as temp_dir:
+        manifest = FileManifest(target, os.path.join(temp_dir, "manifest_cache.json"))
+        start = time.monotonic()
+        entries = manifest.scan()
+        elapsed = time.monotonic() - start
+        total_bytes = sum(entry["size"] for entry in entries.values())
+        print(f"冷启动构建完成: {len(entries)} 个文件, {total_bytes / 1024 / 1024:.1f} MB, 耗时 {elapsed:.2f} 秒")
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""登录器共用的HTTP客户端
+
+整个登录器只使用一个 aiohttp 会话: 连接池保持长连接并缓存DNS解析结果,
+启动、按钮操作和下载都复用已经建立的连接。会话绑定在登录器的事件循环上,
+所有请求都必须在同一个事件循环中执行。
+aiohttp 在第一次创建会话时才导入, 导入发生在事件循环线程中, 不影响登录器窗口的显示。
+"""
+
+
+class HttpClient:
+    # 连接池大小, 需要容纳同时下载的文件数 × 每个文件的分段连接数
+    POOL_SIZE = 32
+    DNS_CACHE_SECONDS = 300
+    KEEPALIVE_SECONDS = 60
+    # 不限制总时间, 大文件下载可能需要很久; 连接和读取分别超时
+    CONNECT_TIMEOUT = 10
+    READ_TIMEOUT = 60
+    # 每个连接的接收缓冲区, 下载时一次可以读取更大的数据块
+    READ_BUFFER_SIZE = 512 * 1024
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.session = None
+        # 带ETag的GET响应缓存: url -> (etag, 响应数据)
+        self.etag_cache = {}
+
+    async def get_session(self):
+        """返回共用的会话, 第一次使用或已关闭时创建"""
+        if self.session is None or self.session.closed:
+            import aiohttp
+            connector = aiohttp.TCPConnector(
+                limit=self.POOL_SIZE,
+                ttl_dns_cache=self.DNS_CACHE_SECONDS,
+                keepalive_timeout=self.KEEPALIVE_SECONDS
+            )
+            timeout = aiohttp.ClientTimeout(
+                total=None,
+                connect=self.CONNECT_TIMEOUT,
+                sock_read=self.READ_TIMEOUT
+            )
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                                 read_bufsize=self.READ_BUFFER_SIZE)
+        return self.session
+
+    async def fetch_json(self, url):
+        """带ETag缓存的GET请求, 服务器返回304时直接使用上次的响应内容, 失败返回None"""
+        session = await self.get_session()
+        headers = {}
+        cached = self.etag_cache.get(url)
+        if cached:
+            headers["If-None-Match"] = cached[0]
+
+        async with session.get(url, headers=headers) as response:
+            if response.status == 304 and cached:
+                return cached[1]
+            if response.status == 200:
+                data = await response.json()
+                etag = response.headers.get("ETag")
+                if etag:
+                    self.etag_cache[url] = (etag, data)
+                return data
+            return None
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
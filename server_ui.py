@@ -7,7 +7,7 @@ import uvicorn
 import threading
 import asyncio
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional
@@ -15,20 +15,47 @@ from datetime import datetime
 from config import CONFIG, save_config, load_config
 from network_opcodes import Opcodes
 import os
+import math
 import base64
 import http.client
 import xml.etree.ElementTree as ET
 import hashlib
 import json
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 import urllib.parse
 import mysql.connector
 from mysql.connector import Error
 import random
+import multiprocessing
 from mpq_encryptor import MPQEncryptor  # 添加导入
+from file_manifest import FileManifest, ManifestWatcher, build_tree, BLOCK_SIZE, PRIORITIES, PRIORITY_NORMAL
 
 # 在文件开头添加一个全局变量来存储白名单
 GLOBAL_MPQ_WHITELIST = set()
+# 文件更新优先级规则 [(路径模式, 优先级)], 按顺序第一个匹配的规则生效
+GLOBAL_FILE_PRIORITY = []
+# 安装方案 [{"name", "title", "tags"}], 第一个为默认方案; 可选内容规则 [(路径模式, 标签)]
+GLOBAL_INSTALL_PROFILES = []
+GLOBAL_OPTIONAL_CONTENT = []
+
+# Download目录的文件哈希清单, 缓存文件放在Download目录旁边
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+FILE_MANIFEST = FileManifest(
+    os.path.join(BASE_DIR, "Download"),
+    os.path.join(BASE_DIR, "manifest_cache.json"),
+    os.path.join(BASE_DIR, "delta_cache")
+)
+# 待发布版本: Pending目录中放入下一个版本的文件(目录结构同Download), 登录器在后台预先下载,
+# 把文件移入Download目录即为发布, 已预先下载的登录器更新时只需替换文件
+PENDING_MANIFEST = FileManifest(
+    os.path.join(BASE_DIR, "Pending"),
+    os.path.join(BASE_DIR, "pending_manifest_cache.json")
+)
+# 后台文件监视线程, 随服务器启动
+MANIFEST_WATCHER = None
+PENDING_WATCHER = None
+# 按清单版本和配置缓存的哈希树, generation和mpq_whitelist取自构建哈希树时的清单
+MANIFEST_TREE = {"key": None, "tree": None, "generation": 0, "mpq_whitelist": []}
 
 # 将FastAPI应用命名为api_app而不是app
 api_app = FastAPI(title="无限魔兽服务器")
@@ -42,6 +69,16 @@ api_app.add_middleware(
     allow_headers=["*"],
 )
 
+def etag_matches(request, etag):
+    """判断请求头If-None-Match是否包含指定的ETag"""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return etag in tags or f"W/{etag}" in tags
+
 def get_db_connection():
     """创建数据库连接"""
     try:
@@ -224,8 +261,8 @@ async def handle_request(request: Request):
         raise HTTPException(status_code=500, detail=str(e))
 
 @api_app.get("/server_info")
-async def get_server_info():
-    """获取服务器信息"""
+async def get_server_info(request: Request):
+    """获取服务器信息, 内容未变化时返回304"""
     try: 
         # 加载公告
         try:
@@ -246,17 +283,37 @@ async def get_server_info():
             "check_update_before_play": (CONFIG.get("check_update_before_play", 1)),
             "max_client_count": CONFIG.get("max_client_count", 3),
             "announcements": announcements,  
-            "encryption_key": CONFIG.get("encryption_key", "@@112233")
+            "encryption_key": CONFIG.get("encryption_key", "@@112233"),
+            # 大文件分段下载的连接数和文件大小阈值
+            "download_segments": CONFIG.get("download_segments", 4),
+            "segment_threshold_mb": CONFIG.get("segment_threshold_mb", 64),
+            # 登录器本地文件校验模式: quick/standard/deep
+            "verify_mode": CONFIG.get("verify_mode", "standard"),
+            # 建议的下载限速(KB/s, 0为不限速): 更新下载和后台预下载, 玩家可以在登录器中修改
+            "download_limit_kb": CONFIG.get("download_limit_kb", 0),
+            "background_limit_kb": CONFIG.get("background_limit_kb", 1024),
+            # 安装方案, 玩家在登录器中选择要同步的可选内容
+            "install_profiles": GLOBAL_INSTALL_PROFILES
         }
-        return JSONResponse(content=server_info)
+
+        # ETag取自响应内容的哈希, 配置、在线人数或公告变化时自动变化
+        body = json.dumps(server_info, ensure_ascii=False, sort_keys=True)
+        etag = f'"{hashlib.md5(body.encode("utf-8")).hexdigest()}"'
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        return JSONResponse(content=server_info, headers={"ETag": etag})
         
     except Exception as e:
         print(f"获取服务器信息失败: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 class ServerUI(QMainWindow):
+    # 供其他线程写入日志的信号
+    log_signal = pyqtSignal(str)
+
     def __init__(self):
         super().__init__()
+        self.log_signal.connect(self.log_message)
         self.server_thread = None
         self.server_running = False
         self.download_path = "Download"
@@ -266,8 +323,11 @@ class ServerUI(QMainWindow):
 
         self.load_saved_config()
         # 初始化时加载白名单到全局变量
-        global GLOBAL_MPQ_WHITELIST
+        global GLOBAL_MPQ_WHITELIST, GLOBAL_FILE_PRIORITY
         GLOBAL_MPQ_WHITELIST = self.load_mpq_whitelist()
+        GLOBAL_FILE_PRIORITY = self.load_file_priority()
+        global GLOBAL_INSTALL_PROFILES, GLOBAL_OPTIONAL_CONTENT
+        GLOBAL_INSTALL_PROFILES, GLOBAL_OPTIONAL_CONTENT = self.load_install_profiles()
 
     def setup_ui(self):
         # 设置窗口基本属性
@@ -634,6 +694,11 @@ class ServerUI(QMainWindow):
                 "mysql_database": self.mysql_database.text(),
                 
                 "encryption_key": self.encryption_key.text(),
+                "download_segments": CONFIG.get("download_segments", 4),
+                "segment_threshold_mb": CONFIG.get("segment_threshold_mb", 64),
+                "verify_mode": CONFIG.get("verify_mode", "standard"),
+                "download_limit_kb": CONFIG.get("download_limit_kb", 0),
+                "background_limit_kb": CONFIG.get("background_limit_kb", 1024),
                 
                 "jwt_secret": CONFIG.get("jwt_secret", "your-secret-key"),
                 "token_expire_minutes": CONFIG.get("token_expire_minutes", 60),
@@ -662,6 +727,25 @@ class ServerUI(QMainWindow):
     def run_server(self):
         """在新线程中运行服务器"""
         try:
+            # 启动前先构建文件清单, 进度输出到服务器日志
+            FILE_MANIFEST.log = self.log_signal.emit
+            FILE_MANIFEST.scan()
+
+            # 启动文件监视, 之后新增或修改的补丁只增量计算哈希
+            global MANIFEST_WATCHER
+            if MANIFEST_WATCHER is None or not MANIFEST_WATCHER.is_alive():
+                MANIFEST_WATCHER = ManifestWatcher(FILE_MANIFEST)
+                MANIFEST_WATCHER.start()
+
+            # 待发布版本的文件清单
+            os.makedirs(PENDING_MANIFEST.download_path, exist_ok=True)
+            PENDING_MANIFEST.log = self.log_signal.emit
+            PENDING_MANIFEST.scan()
+            global PENDING_WATCHER
+            if PENDING_WATCHER is None or not PENDING_WATCHER.is_alive():
+                PENDING_WATCHER = ManifestWatcher(PENDING_MANIFEST)
+                PENDING_WATCHER.start()
+
             config = uvicorn.Config(
                 app=api_app,
                 host=CONFIG.get("server_host", "0.0.0.0"),  # 使用扁平化的配置
@@ -871,6 +955,56 @@ class ServerUI(QMainWindow):
             
         return whitelist
 
+    def load_file_priority(self):
+        """加载文件更新优先级规则, 每行为 "优先级 路径模式", #开头为注释"""
+        rules = []
+        try:
+            if not os.path.exists('FilePriority.txt'):
+                return rules
+            with open('FilePriority.txt', 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line or line.startswith('#'):
+                        continue
+                    parts = line.split(None, 1)
+                    if len(parts) != 2 or parts[0].lower() not in PRIORITIES:
+                        self.log_message(f"忽略无效的优先级规则: {line}")
+                        continue
+                    rules.append((parts[1].strip().lower(), parts[0].lower()))
+            self.log_message(f"已加载文件优先级规则: {len(rules)}条")
+        except Exception as e:
+            self.log_message(f"加载文件优先级规则失败: {str(e)}")
+        return rules
+
+    def load_install_profiles(self):
+        """加载安装方案和可选内容规则, 返回 (安装方案列表, 可选内容规则)
+
+        "profile 方案名 显示名称 [标签,标签...]" 定义安装方案及其包含的可选内容,
+        "optional 标签 路径模式" 给匹配的文件加上可选内容标签, #开头为注释。
+        """
+        profiles = []
+        rules = []
+        try:
+            if not os.path.exists('InstallProfiles.txt'):
+                return profiles, rules
+            with open('InstallProfiles.txt', 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line or line.startswith('#'):
+                        continue
+                    parts = line.split()
+                    if parts[0].lower() == 'profile' and len(parts) in (3, 4):
+                        tags = sorted({tag.strip().lower() for tag in parts[3].split(',') if tag.strip()}) if len(parts) == 4 else []
+                        profiles.append({"name": parts[1], "title": parts[2], "tags": tags})
+                    elif parts[0].lower() == 'optional' and len(parts) == 3:
+                        rules.append((parts[2].lower(), parts[1].lower()))
+                    else:
+                        self.log_message(f"忽略无效的安装方案配置: {line}")
+            self.log_message(f"已加载安装方案: {len(profiles)}个, 可选内容规则: {len(rules)}条")
+        except Exception as e:
+            self.log_message(f"加载安装方案失败: {str(e)}")
+        return profiles, rules
+
     def on_save_clicked(self):
         """保存按钮点击处理"""
         try:
@@ -1032,74 +1166,171 @@ class ServerUI(QMainWindow):
             QMessageBox.warning(self, "错误", error_msg)
 
 
+def build_file_info(relative_path, entry, mpq_whitelist):
+    """根据目录和配置生成单个文件的清单条目, 不需要下发的文件返回None"""
+    file = relative_path.rsplit('/', 1)[-1]
+
+    # 根据不同目录和配置决定是否加文件
+    if relative_path.startswith('Wow/'):
+        # Wow目录下的文件只在force_wow=1添加
+        if int(CONFIG.get("force_wow", 0)) != 1:
+            return None
+        print(f"添加Wow目录文件: {relative_path}")
+        file_info = {
+            'hash': entry['hash'],
+            'size': entry['size'],
+            'is_mpq': False,
+            'in_whitelist': False,
+            'is_wow_file': True,
+            'is_data_file': False
+        }
+    elif relative_path.startswith('Data/'):
+        # Data目录下的文件始终添加
+        file_lower = file.lower()
+        is_mpq = file_lower.endswith('.mpq')
+        in_whitelist = file_lower in mpq_whitelist if is_mpq else False
+        
+        print(f"添加Data目录文件: {relative_path}")
+        print(f"- 是否MPQ: {is_mpq}")
+        print(f"- 是否在白名单: {in_whitelist}")
+        
+        file_info = {
+            'hash': entry['hash'],
+            'size': entry['size'],
+            'is_mpq': is_mpq,
+            'in_whitelist': in_whitelist,
+            'is_wow_file': False,
+            'is_data_file': True
+        }
+    else:
+        # 其他目录的文件始终添加
+        print(f"添加其他目录件: {relative_path}")
+        file_info = {
+            'hash': entry['hash'],
+            'size': entry['size'],
+            'is_mpq': False,
+            'in_whitelist': False,
+            'is_wow_file': False,
+            'is_data_file': False
+        }
+
+    if entry.get('deltas'):
+        # 可用的差异文件: 旧版本哈希 -> 差异文件大小
+        file_info['deltas'] = entry['deltas']
+    priority = get_file_priority(relative_path)
+    if priority != PRIORITY_NORMAL:
+        file_info['priority'] = priority
+    tags = get_content_tags(relative_path)
+    if tags:
+        # 可选内容, 只有安装方案包含其中一个标签的客户端才同步
+        file_info['tags'] = tags
+    return file_info
+
+def get_file_priority(relative_path):
+    """按优先级规则返回文件的更新优先级, 没有匹配的规则时为normal"""
+    path = PurePosixPath(relative_path.lower())
+    for pattern, priority in GLOBAL_FILE_PRIORITY:
+        if path.match(pattern):
+            return priority
+    return PRIORITY_NORMAL
+
+def get_content_tags(relative_path):
+    """文件的可选内容标签(排序后的列表), 不是可选内容时为空列表"""
+    path = PurePosixPath(relative_path.lower())
+    return sorted({tag for pattern, tag in GLOBAL_OPTIONAL_CONTENT if path.match(pattern)})
+
+def get_config_key():
+    """影响下发清单内容的配置的摘要, 配置变化后客户端需要重新获取完整清单"""
+    return hashlib.md5(json.dumps(
+        [int(CONFIG.get("force_wow", 0)), sorted(GLOBAL_MPQ_WHITELIST), GLOBAL_FILE_PRIORITY, GLOBAL_OPTIONAL_CONTENT]
+    ).encode("utf-8")).hexdigest()[:8]
+
+def get_mpq_whitelist(manifest):
+    """全局白名单加上服务器运行期间新放入Data目录的MPQ"""
+    mpq_whitelist = GLOBAL_MPQ_WHITELIST.copy()
+    for relative_path in manifest:
+        if relative_path.count('/') == 1 and relative_path.startswith('Data/') and relative_path.lower().endswith('.mpq'):
+            mpq_whitelist.add(relative_path[len('Data/'):].lower())
+    return mpq_whitelist
+
+def get_manifest_state():
+    """获取下发清单的哈希树及其对应的清单版本, 清单版本或配置变化时重新构建"""
+    global MANIFEST_TREE
+    cache_key = f"{FILE_MANIFEST.version_tag()}-{get_config_key()}"
+    if MANIFEST_TREE["key"] != cache_key:
+        # 版本号和清单在同一时刻读取, 构建期间文件监视线程提交的变化留到下次请求
+        generation, manifest = FILE_MANIFEST.versioned_snapshot()
+        mpq_whitelist = get_mpq_whitelist(manifest)
+        files_info = {}
+        for relative_path, entry in manifest.items():
+            file_info = build_file_info(relative_path, entry, mpq_whitelist)
+            if file_info:
+                files_info[relative_path] = file_info
+        MANIFEST_TREE = {
+            "key": f"{FILE_MANIFEST.manifest_id}-{generation}-{get_config_key()}",
+            "tree": build_tree(files_info),
+            "generation": generation,
+            "mpq_whitelist": list(mpq_whitelist)
+        }
+    return MANIFEST_TREE
+
+def get_manifest_tree():
+    return get_manifest_state()["tree"]
+
 # 添加新的API路由
 @api_app.get("/check_update")
-async def check_update():
-    """获取服务器文件列表并处理MPQ同步"""
+async def check_update(request: Request, since: Optional[int] = None,
+                       manifest_id: Optional[str] = None, config_key: Optional[str] = None):
+    """获取服务器文件列表并处理MPQ同步
+
+    带上 since/manifest_id/config_key 时只返回该版本之后变化的文件(delta),
+    变更记录已无法覆盖该版本或配置已变化时返回完整清单。
+    """
     try:
-        download_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Download")
-        print(f"扫描目录: {download_path}") 
+        # ETag由清单版本号和影响清单内容的配置组成, 未变化时直接返回304, 不构建清单
+        current_config_key = get_config_key()
+        etag = f'"{FILE_MANIFEST.version_tag()}-{current_config_key}"'
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+
+        # 判断能否只返回变化的部分, 版本号必须在读取清单之前获取
+        changes = None
+        if since is not None and manifest_id == FILE_MANIFEST.manifest_id and config_key == current_config_key:
+            changes = FILE_MANIFEST.changes_since(since)
+        generation = changes[0] if changes else FILE_MANIFEST.generation
 
         files_info = {}
+        removed = []
         
-        # 使用全局白名单
-        mpq_whitelist = GLOBAL_MPQ_WHITELIST.copy()  
-
-        # 扫描Download目录
-        for root, _, files in os.walk(download_path):
-            for file in files:
-                full_path = os.path.join(root, file)
-                relative_path = os.path.relpath(full_path, download_path)
-                relative_path = relative_path.replace('\\', '/')
-                
-                # 根据不同目录和配置决定是否加文件
-                if relative_path.startswith('Wow/'):
-                    # Wow目录下的文件只在force_wow=1添加
-                    if int(CONFIG.get("force_wow", 0)) == 1:
-                        print(f"添加Wow目录文件: {relative_path}")
-                        files_info[relative_path] = {
-                            'hash': hashlib.md5(open(full_path, 'rb').read()).hexdigest(),
-                            'size': os.path.getsize(full_path),
-                            'is_mpq': False,
-                            'in_whitelist': False,
-                            'is_wow_file': True,
-                            'is_data_file': False
-                        }
-                elif relative_path.startswith('Data/'):
-                    # Data目录下的文件始终添加
-                    file_lower = file.lower()
-                    is_mpq = file_lower.endswith('.mpq')
-                    in_whitelist = file_lower in mpq_whitelist if is_mpq else False
-                    
-                    print(f"添加Data目录文件: {relative_path}")
-                    print(f"- 是否MPQ: {is_mpq}")
-                    print(f"- 是否在白名单: {in_whitelist}")
-                    
-                    files_info[relative_path] = {
-                        'hash': hashlib.md5(open(full_path, 'rb').read()).hexdigest(),
-                        'size': os.path.getsize(full_path),
-                        'is_mpq': is_mpq,
-                        'in_whitelist': in_whitelist,
-                        'is_wow_file': False,
-                        'is_data_file': True
-                    }
+        # 直接使用后台监视线程维护的内存清单, 不再每次扫描目录
+        manifest = FILE_MANIFEST.snapshot()
+
+        # 使用全局白名单, 并加入服务器运行期间新放入Data目录的MPQ
+        mpq_whitelist = get_mpq_whitelist(manifest)
+
+        if changes:
+            # 只返回变化的文件, 已删除的文件单独列出
+            for relative_path in sorted(changes[1]):
+                entry = manifest.get(relative_path)
+                file_info = build_file_info(relative_path, entry, mpq_whitelist) if entry else None
+                if file_info:
+                    files_info[relative_path] = file_info
                 else:
-                    # 其他目录的文件始终添加
-                    print(f"添加其他目录件: {relative_path}")
-                    files_info[relative_path] = {
-                        'hash': hashlib.md5(open(full_path, 'rb').read()).hexdigest(),
-                        'size': os.path.getsize(full_path),
-                        'is_mpq': False,
-                        'in_whitelist': False,
-                        'is_wow_file': False,
-                        'is_data_file': False
-                    }
-
-
+                    removed.append(relative_path)
+        else:
+            for relative_path, entry in manifest.items():
+                file_info = build_file_info(relative_path, entry, mpq_whitelist)
+                if file_info:
+                    files_info[relative_path] = file_info
 
         # 构建响应数据，添加更多信息
         response_data = {
             "files": files_info,
+            "removed": removed,
+            "delta": changes is not None,
+            "generation": generation,
+            "manifest_id": FILE_MANIFEST.manifest_id,
+            "config_key": current_config_key,
             "mpq_whitelist": list(mpq_whitelist)    
         }
                 
@@ -1109,6 +1340,7 @@ async def check_update():
             media_type="application/json",
             headers={
                 "Content-Type": "application/json; charset=utf-8",
+                "ETag": etag,
             }
         )
         
@@ -1118,35 +1350,267 @@ async def check_update():
         print(f"异常详情: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@api_app.get("/manifest/root")
+async def get_manifest_root():
+    """获取哈希树根节点信息, 客户端根哈希相同时无需再请求其他内容"""
+    try:
+        state = get_manifest_state()
+        return JSONResponse(content={
+            "root_hash": state["tree"][""]["hash"],
+            "generation": state["generation"],
+            "change_log_start": FILE_MANIFEST.change_log_start,
+            "manifest_id": FILE_MANIFEST.manifest_id,
+            "config_key": get_config_key(),
+            "mpq_whitelist": state["mpq_whitelist"]
+        })
+    except Exception as e:
+        print(f"获取清单根节点失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_app.get("/manifest/tree")
+async def get_manifest_tree_node(request: Request, path: str = ""):
+    """获取哈希树中一个目录的节点: 子目录哈希和文件列表"""
+    try:
+        node = get_manifest_tree().get(path.strip('/'))
+        if node is None:
+            raise HTTPException(status_code=404, detail=f"目录不存在: {path}")
+
+        # 目录哈希由内容计算得出, 直接作为ETag
+        etag = f'"{node["hash"]}"'
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        return JSONResponse(content=node, headers={"ETag": etag})
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"获取清单目录失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_app.get("/manifest/blocks/{file_path:path}")
+async def get_file_blocks(request: Request, file_path: str):
+    """获取文件的分块校验列表, 登录器据此只下载内容不同的块"""
+    try:
+        file_path = urllib.parse.unquote(file_path).replace('\\', '/')
+        entry = FILE_MANIFEST.get_entry(file_path)
+        if entry is None:
+            raise HTTPException(status_code=404, detail=f"文件不存在: {file_path}")
+
+        etag = f'"{entry["hash"]}"'
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        return JSONResponse(content={
+            "hash": entry["hash"],
+            "size": entry["size"],
+            "block_size": BLOCK_SIZE,
+            "blocks": entry.get("blocks", [])
+        }, headers={"ETag": etag})
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"获取文件分块失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def read_file_range(full_path, offset, length):
+    """按块读取文件中从offset开始的length字节"""
+    with open(full_path, 'rb') as f:
+        f.seek(offset)
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(BLOCK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+@api_app.get("/download_blocks/{file_path:path}")
+async def download_blocks(file_path: str, hash: str, start: int, count: int = 1):
+    """下载文件中从第start块开始的count个连续块
+
+    hash为登录器期望的文件版本, 服务器文件已变化时返回409, 避免把不同版本的块拼在一起。
+    块范围超出文件时返回416。
+    """
+    try:
+        file_path = urllib.parse.unquote(file_path).replace('\\', '/')
+        entry = FILE_MANIFEST.get_entry(file_path)
+        if entry is None:
+            raise HTTPException(status_code=404, detail=f"文件不存在: {file_path}")
+        if entry["hash"] != hash:
+            raise HTTPException(status_code=409, detail=f"文件已更新: {file_path}")
+        if start < 0 or count < 1:
+            raise HTTPException(status_code=400, detail="块范围无效")
+        block_count = math.ceil(entry["size"] / BLOCK_SIZE)
+        if start + count > block_count:
+            raise HTTPException(status_code=416, detail=f"块范围超出文件: 共 {block_count} 块",
+                                headers={"Content-Range": f"bytes */{entry['size']}"})
+
+        full_path = os.path.join(FILE_MANIFEST.download_path, file_path)
+        offset = start * BLOCK_SIZE
+        length = min(count * BLOCK_SIZE, entry["size"] - offset)
+
+        return StreamingResponse(
+            read_file_range(full_path, offset, length),
+            media_type='application/octet-stream',
+            headers={"Content-Length": str(length)}
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"下载文件分块失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@api_app.get("/download_delta/{file_path:path}")
+async def download_delta(file_path: str, base: str):
+    """下载从旧版本base到当前版本的差异文件"""
+    try:
+        file_path = urllib.parse.unquote(file_path).replace('\\', '/')
+        entry = FILE_MANIFEST.get_entry(file_path)
+        if entry is None:
+            raise HTTPException(status_code=404, detail=f"文件不存在: {file_path}")
+        if base not in entry.get("deltas", {}):
+            raise HTTPException(status_code=404, detail=f"没有可用的差异文件: {file_path}")
+
+        delta_path = FILE_MANIFEST.delta_path(base, entry["hash"])
+        if not os.path.isfile(delta_path):
+            raise HTTPException(status_code=404, detail=f"没有可用的差异文件: {file_path}")
+        return FileResponse(path=delta_path, media_type='application/octet-stream')
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"下载差异文件失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def parse_range(range_header, size):
+    """解析Range请求头, 返回(起始, 结束)字节位置(含结束位置)
+
+    只支持单个范围; 格式不支持时返回None(按完整文件响应), 范围无法满足时返回(size, size)。
+    """
+    if not range_header or not range_header.startswith("bytes="):
+        return None
+    spec = range_header[6:].strip()
+    if "," in spec or "-" not in spec:
+        return None
+    first, last = spec.split("-", 1)
+    try:
+        if first == "":
+            # bytes=-N 表示最后N字节
+            suffix = int(last)
+            if suffix <= 0:
+                return (size, size)
+            return (max(0, size - suffix), size - 1)
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return (size, size)
+    return (start, min(end, size - 1))
+
 @api_app.get("/download/{file_path:path}")
-async def download_file(file_path: str):
-    """下载指定文件"""
+async def download_file(file_path: str, request: Request):
+    """下载指定文件
+
+    支持Range/If-Range断点续传: 登录器带上已下载的字节数和文件哈希(ETag),
+    文件未变化时返回206和剩余部分, 文件已更新时返回完整的新文件。
+    """
+    return serve_download(FILE_MANIFEST, file_path, request)
+
+@api_app.get("/pending/download/{file_path:path}")
+async def download_pending_file(file_path: str, request: Request):
+    """下载待发布版本的文件, 和/download相同支持断点续传"""
+    return serve_download(PENDING_MANIFEST, file_path, request)
+
+@api_app.get("/pending/manifest")
+async def get_pending_manifest(request: Request):
+    """获取待发布版本的文件清单, 没有待发布版本时release_id为None, files为空"""
+    try:
+        manifest = PENDING_MANIFEST.snapshot()
+        release_id = PENDING_MANIFEST.version_tag() if manifest else None
+        etag = f'"{release_id}-{get_config_key()}"'
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+
+        mpq_whitelist = get_mpq_whitelist(manifest)
+        files_info = {}
+        for relative_path, entry in manifest.items():
+            file_info = build_file_info(relative_path, entry, mpq_whitelist)
+            if file_info:
+                files_info[relative_path] = file_info
+        return JSONResponse(content={"release_id": release_id, "files": files_info}, headers={"ETag": etag})
+    except Exception as e:
+        print(f"获取待发布版本清单失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def serve_download(manifest, file_path, request):
+    """从manifest对应的目录返回文件, 处理Range/If-Range请求"""
     try:
         # 解码文件路径
         file_path = urllib.parse.unquote(file_path)
         # 规范化路径分隔符
         file_path = file_path.replace('\\', '/')
-        # 构建完整的文件路径
-        full_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Download", file_path)
+        # 构建完整的文件路径, 不允许用 ../ 或绝对路径访问目录以外的文件
+        root = os.path.abspath(manifest.download_path)
+        full_path = os.path.abspath(os.path.join(root, file_path))
+        if os.path.commonpath([root, full_path]) != root:
+            print(f"拒绝下载目录以外的文件: {file_path}")
+            raise HTTPException(status_code=403, detail=f"路径无效: {file_path}")
         
         print(f"请下载文件: {file_path}")
         print(f"完整路径: {full_path}")
         
-        if os.path.exists(full_path) and os.path.isfile(full_path):
+        if not (os.path.exists(full_path) and os.path.isfile(full_path)):
+            print(f"文件不存在: {full_path}")
+            raise HTTPException(status_code=404, detail=f"文件不存在: {file_path}")
+
+        size = os.path.getsize(full_path)
+        # 清单中有的文件用内容哈希作ETag, 否则退回到大小+修改时间
+        entry = manifest.get_entry(file_path)
+        if entry is not None and entry["size"] == size:
+            etag = f'"{entry["hash"]}"'
+        else:
+            st = os.stat(full_path)
+            etag = f'W/"{st.st_size:x}-{st.st_mtime_ns:x}"'
+        headers = {"Accept-Ranges": "bytes", "ETag": etag}
+
+        byte_range = parse_range(request.headers.get("range"), size)
+        if byte_range is not None:
+            # If-Range与当前版本不一致时忽略Range, 返回完整文件
+            if_range = request.headers.get("if-range")
+            if if_range and (if_range != etag or etag.startswith('W/')):
+                byte_range = None
+
+        if byte_range is None:
             return FileResponse(
                 path=full_path,
                 filename=os.path.basename(file_path),
-                media_type='application/octet-stream'
+                media_type='application/octet-stream',
+                headers=headers
             )
-        else:
-            print(f"文件不存在: {full_path}")
-            raise HTTPException(status_code=404, detail=f"文件不存在: {file_path}")
+
+        start, end = byte_range
+        if start >= size:
+            headers["Content-Range"] = f"bytes */{size}"
+            return Response(status_code=416, headers=headers)
+
+        print(f"续传文件: {file_path} 从 {start} 字节开始")
+        length = end - start + 1
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(length)
+        return StreamingResponse(
+            read_file_range(full_path, start, length),
+            status_code=206,
+            media_type='application/octet-stream',
+            headers=headers
+        )
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"下载文件失败: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-
 if __name__ == "__main__":
+    # 文件哈希使用进程池, 打包为exe后需要
+    multiprocessing.freeze_support()
+
     # 将QApplication实例命名为qt_app
     qt_app = QApplication(sys.argv)
     
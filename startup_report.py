@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""登录器启动耗时报告
+
+用 --startup-report 参数启动登录器时, 记录界面线程中每个模块第一次导入的耗时(格式与 python -X importtime 相同)
+和启动各阶段的耗时, 窗口第一次绘制后输出。
+aiohttp、psutil、更新用到的file_manifest等模块应该在第一次使用时才导入, 窗口显示前在界面线程中导入时报告中会特别列出。
+"""
+import sys
+import time
+import builtins
+import threading
+
+# 应该推迟导入的模块
+DEFERRED_MODULES = ("aiohttp", "psutil", "requests", "win32process", "win32con", "file_manifest", "download_manager")
+
+
+class StartupReport:
+    # 报告中列出的耗时最多的模块数
+    TOP_IMPORTS = 20
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.enabled = False
+        self.phases = []
+        # (模块名, 嵌套深度, 自身耗时, 累计耗时), 单位微秒, 按导入完成的顺序
+        self.imports = []
+        self.stack = []
+        self.original_import = builtins.__import__
+
+    def enable(self):
+        """替换__import__, 记录之后界面线程中第一次导入的模块"""
+        self.enabled = True
+        self.main_thread = threading.get_ident()
+        builtins.__import__ = self.timed_import
+
+    def timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules or threading.get_ident() != self.main_thread:
+            return self.original_import(name, globals, locals, fromlist, level)
+        # 子模块的耗时计入当前模块的累计耗时, 从自身耗时中扣除
+        self.stack.append(0)
+        start = time.perf_counter()
+        try:
+            return self.original_import(name, globals, locals, fromlist, level)
+        finally:
+            cumulative = int((time.perf_counter() - start) * 1000000)
+            children = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += cumulative
+            self.imports.append((name, len(self.stack), cumulative - children, cumulative))
+
+    def mark(self, phase):
+        """记录一个启动阶段结束的时间"""
+        if self.enabled:
+            self.phases.append((phase, time.perf_counter()))
+
+    def finish(self):
+        """恢复__import__并输出报告"""
+        if not self.enabled:
+            return
+        builtins.__import__ = self.original_import
+        self.enabled = False
+
+        print("启动耗时报告")
+        last = self.start
+        for phase, at in self.phases:
+            print(f"  {phase}: {(at - last) * 1000:.0f} ms (累计 {(at - self.start) * 1000:.0f} ms)")
+            last = at
+
+        print(f"界面线程导入耗时最多的模块(前{self.TOP_IMPORTS}个):")
+        print("import time: self [us] | cumulative | imported package")
+        top = sorted(self.imports, key=lambda item: item[3], reverse=True)[:self.TOP_IMPORTS]
+        for name, depth, self_time, cumulative in top:
+            print(f"import time: {self_time:>9} | {cumulative:>10} | {'  ' * depth}{name}")
+
+        imported = {name for name, depth, self_time, cumulative in self.imports}
+        eager = [name for name in DEFERRED_MODULES
+                 if any(module == name or module.startswith(name + ".") for module in imported)]
+        if eager:
+            print(f"警告: 以下模块应在第一次使用时导入, 但在窗口显示前已经导入: {', '.join(eager)}")
+
+
+STARTUP_REPORT = StartupReport()
+if "--startup-report" in sys.argv:
+    STARTUP_REPORT.enable()